@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import operator
+import threading
+from collections import deque
+
+
+
+#######################################################################################
+#                                    ALERT RULES                                      #
+#######################################################################################
+
+#alerts are rules over sliding windows of observations (or lightning strikes), checked as each one arrives.
+#A rule compares a statistic of one variable over its window with a threshold:
+#   {"name": "gust", "var": "wgust", "stat": "max", "window": 600, "op": ">", "value": 30, "message": "Wind gusts to {value:.0f} mph"}
+#var: an observation variable (temp in F, other wxobs units) or "strike" (distance of each strike, km)
+#stat: value (latest, if within the window), max, min, mean, sum, count, drop (max - latest) or rise (latest - min)
+#message: formatted with value (the statistic) and minutes (since the observation it came from)
+#A rule is active while its condition holds, and reports when it became true- so "value" rules alert on threshold crossings.
+#Every statistic is kept by a windowed aggregate updated in O(1) amortized time per observation (monotonic deques for
+#max/min, running sums for mean/sum/count). Aggregates are shared between statistics, and each statistic is computed
+#once per observation for all the rules testing it.
+
+
+DEFAULT_RULES = [
+    {'name': 'lightning', 'var': 'strike', 'stat': 'min', 'window': 1800, 'op': '<=', 'value': 30,
+     'message': "Lightning detected {minutes} minutes ago, {value:.0f} km away"},
+    {'name': 'gust', 'var': 'wgust', 'stat': 'max', 'window': 600, 'op': '>', 'value': 30, 'message': "Wind gusts to {value:.0f} mph"},
+    {'name': 'heavy_rain', 'var': 'precip', 'stat': 'mean', 'window': 3600, 'op': '>', 'value': 8, 'message': "Heavy rain, {value:.1f} mm/hr over the last hour"},
+    {'name': 'pressure_drop', 'var': 'pres', 'stat': 'drop', 'window': 10800, 'op': '>', 'value': 3, 'message': "Pressure down {value:.1f} mb in 3 hours"},
+    {'name': 'freezing', 'var': 'temp', 'stat': 'value', 'window': 3600, 'op': '<=', 'value': 32, 'message': "Temperature at or below freezing"},
+]
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+#aggregates needed by each statistic
+STAT_AGGREGATES = {'value': ['latest'], 'max': ['max'], 'min': ['min'], 'mean': ['sum'], 'sum': ['sum'], 'count': ['sum'],
+                   'drop': ['max', 'latest'], 'rise': ['min', 'latest']}
+
+
+
+#maximum (or minimum, sign=-1) over the last window seconds: a deque of (epoch, value) with values decreasing
+#from the front, so each value is appended and removed at most once
+class WindowExtreme():
+
+    def __init__(self, window, sign=1):
+        self.window = window
+        self.sign = sign
+        self.items = deque()
+
+    def push(self, epoch, value):
+        value = self.sign*value
+        while self.items and self.items[-1][1] <= value:
+            self.items.pop()
+        self.items.append((epoch, value))
+
+    def expire(self, now):
+        while self.items and self.items[0][0] <= now - self.window:
+            self.items.popleft()
+
+    #(epoch, value) of the extreme, or None if the window is empty
+    def result(self):
+        if not self.items:
+            return None
+        epoch, value = self.items[0]
+        return epoch, self.sign*value
+
+
+
+#running sum and count over the last window seconds
+class WindowSum():
+
+    def __init__(self, window):
+        self.window = window
+        self.items = deque()
+        self.total = 0.0
+
+    def push(self, epoch, value):
+        self.items.append((epoch, value))
+        self.total += value
+
+    def expire(self, now):
+        while self.items and self.items[0][0] <= now - self.window:
+            self.total -= self.items.popleft()[1]
+        if not self.items:
+            self.total = 0.0 #drop accumulated rounding error
+
+    #(epoch of the newest value, sum, count), or None if the window is empty
+    def result(self):
+        if not self.items:
+            return None
+        return self.items[-1][0], self.total, len(self.items)
+
+
+
+#latest value, if it is less than window seconds old
+class WindowLatest():
+
+    def __init__(self, window):
+        self.window = window
+        self.item = None
+
+    def push(self, epoch, value):
+        self.item = (epoch, value)
+
+    def expire(self, now):
+        if self.item is not None and self.item[0] <= now - self.window:
+            self.item = None
+
+    def result(self):
+        return self.item
+
+
+
+AGGREGATES = {'max': lambda window: WindowExtreme(window), 'min': lambda window: WindowExtreme(window, sign=-1),
+              'sum': WindowSum, 'latest': WindowLatest}
+
+
+
+#a statistic of one variable over a window, shared by every rule that tests it
+class WindowStatistic():
+
+    def __init__(self, stat, aggregates):
+        self.stat = stat
+        self.aggregates = aggregates
+        self.rules = []
+
+
+    #(epoch, value) from the aggregates, or None without observations in the window
+    def result(self):
+        results = [aggregate.result() for aggregate in self.aggregates]
+        if None in results:
+            return None
+        if self.stat in ['value', 'max', 'min']:
+            return results[0]
+        if self.stat in ['mean', 'sum', 'count']:
+            epoch, total, count = results[0]
+            return epoch, {'mean': total/count, 'sum': total, 'count': count}[self.stat]
+        (_, extreme), (epoch, latest) = results
+        return epoch, extreme - latest if self.stat == 'drop' else latest - extreme
+
+
+
+class AlertRule():
+
+    def __init__(self, name, var, stat, window, op, value, message):
+        if stat not in STAT_AGGREGATES or op not in OPERATORS:
+            raise ValueError(f"alert rule {name}: unknown stat {stat} or op {op}")
+        self.name = name
+        self.var = var
+        self.stat = stat
+        self.window = window
+        self.compare = OPERATORS[op]
+        self.threshold = value
+        self.message = message
+
+
+
+class AlertEngine():
+
+    #rules are dicts as in DEFAULT_RULES
+    def __init__(self, rules):
+        self.rules = [AlertRule(**rule) for rule in rules]
+        self.aggregates = {} #(var, kind, window): aggregate
+        self.statistics = {} #(var, stat, window): WindowStatistic
+        self.var_aggregates = {} #var: [aggregates]
+        self.var_statistics = {} #var: [WindowStatistic]
+        self.newest = {} #var: epoch of the newest value seen
+        self.since = {} #rule name: epoch the active rule became true
+        self.lock = threading.Lock()
+
+        for rule in self.rules:
+            key = (rule.var, rule.stat, rule.window)
+            if key not in self.statistics:
+                self.statistics[key] = WindowStatistic(rule.stat, [self.aggregate(rule.var, kind, rule.window) for kind in STAT_AGGREGATES[rule.stat]])
+                self.var_statistics.setdefault(rule.var, []).append(self.statistics[key])
+            self.statistics[key].rules.append(rule)
+
+
+    def aggregate(self, var, kind, window):
+        key = (var, kind, window)
+        if key not in self.aggregates:
+            self.aggregates[key] = AGGREGATES[kind](window)
+            self.var_aggregates.setdefault(var, []).append(self.aggregates[key])
+        return self.aggregates[key]
+
+
+    #adds one observation ({var: value}, e.g. {"strike": km}) and checks the rules on its variables
+    #values older than the newest one already seen are ignored (late uploads don't rewrite the windows), as are
+    #NaN values (masked by quality control)
+    #returns the alerts it made active
+    def observe(self, epoch, values):
+        triggered = []
+        with self.lock:
+            for var, value in values.items():
+                if var not in self.var_statistics or epoch < self.newest.get(var, epoch) or value != value:
+                    continue
+                self.newest[var] = epoch
+                for aggregate in self.var_aggregates[var]:
+                    aggregate.push(epoch, value)
+                    aggregate.expire(epoch)
+                for statistic in self.var_statistics[var]:
+                    result = statistic.result()
+                    for rule in statistic.rules:
+                        if self.check(rule, result, epoch) and self.since[rule.name] == epoch:
+                            triggered.append(self.alert(rule, result, epoch))
+        return triggered
+
+
+    #observe() for arrays of observations (epoch seconds, {var: array})
+    def observe_many(self, epoch, columns):
+        triggered = []
+        for i in sorted(range(len(epoch)), key=lambda i: epoch[i]):
+            triggered += self.observe(int(epoch[i]), {var:float(values[i]) for var,values in columns.items()})
+        return triggered
+
+
+    #True if the rule holds for the statistic's result at epoch now, updating when it became active (caller holds self.lock)
+    def check(self, rule, result, now):
+        if result is None or not rule.compare(result[1], rule.threshold):
+            self.since.pop(rule.name, None)
+            return False
+        self.since.setdefault(rule.name, now)
+        return True
+
+
+    def alert(self, rule, result, now):
+        epoch, value = result
+        message = rule.message.format(value=value, minutes=int(round((now - epoch)/60)))
+        return {'name': rule.name, 'message': message, 'value': value, 'since': self.since[rule.name]}
+
+
+    #active alerts at epoch now (windows are expired up to now, so alerts lapse when observations stop)
+    def active(self, now):
+        alerts = []
+        with self.lock:
+            for aggregate in self.aggregates.values():
+                aggregate.expire(now)
+            for statistic in self.statistics.values():
+                result = statistic.result()
+                alerts += [self.alert(rule, result, now) for rule in statistic.rules if self.check(rule, result, now)]
+        return alerts
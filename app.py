@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-from flask import Flask, render_template, url_for, request, redirect
+from flask import Flask, Response, render_template, url_for, request, redirect
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, insert, update, bindparam, func, cast, case, text, Integer
+from sqlalchemy.orm import sessionmaker
 
 from bokeh.embed import components
 from bokeh.models import ColumnDataSource, HoverTool, PrintfTickFormatter, DatetimeTickFormatter, LinearAxis, Range1d
 from bokeh.plotting import figure
 from bokeh.transform import factor_cmap
 
-import shutil
+import os
+import math
 import time
+import threading
+import calendar
 from datetime import datetime, timedelta
 from dateutil import tz
 import timezonefinder, pytz
@@ -17,8 +22,23 @@ from suntime import Sun, SunTimeException
 import numpy as np
 from hashlib import sha1
 import json
+import warnings
 
-from geopy.geocoders import Nominatim
+from observations import ObservationArrays, OB_VARS, rows_array
+from decimate import decimate, target_points, ENVELOPE_VARS
+from rollups import rollup_model, rollups_current, update_rollups, rebuild_buckets, choose_rollup, query_rollup
+from ringbuffer import ObservationRing
+from respcache import ResponseCache
+from obwriter import ObservationWriter
+from export import EXPORTERS
+from geocoding import ReverseGeocoder
+from sharedstate import ChangeNotifier
+from dbconfig import configure_database, tune_engine, create_writer_engine
+from instrument import Instrumentation
+from colstore import ColumnStore
+from alerts import AlertEngine, DEFAULT_RULES
+from qc import QC_BITS, qc_flags, mask_flagged, history_seconds as qc_history_seconds
+from derived import DERIVED_VARS, DERIVED_TEMPS, derive, condition_codes, c_to_f, history_seconds
 
 
 
@@ -29,13 +49,37 @@ from geopy.geocoders import Nominatim
 
 app = Flask(__name__) #creating app instance
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///wxobs.db' #3 slashes = relative path, 4 slashes = absolute
-app.add_template_global(np.round, name='round') #allows HTML templates to use np.round() to round values in tables
+app.config['OBS_BACKEND'] = 'sqlite' #or 'colstore' for range reads from memory-mapped column files (see colstore.py)
+app.config['COLSTORE_PATH'] = os.path.join(app.instance_path, 'colstore')
+app.config['STATION_ELEVATION_M'] = 0 #station height above sea level, for sea-level pressure
+app.config['ALERT_RULES'] = DEFAULT_RULES #see alerts.py, e.g. WXSERVER_ALERT_RULES='[{"name": "gust", ...}]'
+app.config.from_prefixed_env("WXSERVER") #e.g. WXSERVER_WXDB_MMAP_SIZE=0 (see dbconfig.py for the WXDB_ settings)
+
+#allows HTML templates to use np.round() to round values in tables ("-" for values masked by quality control)
+def round_value(value, decimals=0):
+    return "-" if value is None or np.isnan(value) else np.round(value, decimals)
+    
+app.add_template_global(round_value, name='round')
+
+configure_database(app) #WAL, pragmas and read pool size
 db = SQLAlchemy(app) #initialize database
 
+#requests read through db.session, every write goes through a writeSession (one serialized connection)
+with app.app_context():
+    tune_engine(db.engine, app.config)
+    writeSession = sessionmaker(bind=create_writer_engine(db.engine.url, app.config))
+responseCache = ResponseCache(max_entries=256, max_bytes=32*1024*1024, ttl=60) #rendered pages, cleared when station data changes
+instrumentation = Instrumentation(app, authorize=lambda credential: validate_credential(credential)) #Server-Timing, /metrics, X-Profile header
+
+#listener(event, data) functions called with every change pushed to live clients (asgi.py adds its event broker)
+eventListeners = []
+
+def publish_event(event, data):
+    for listener in eventListeners:
+        listener(event, data)
 
-#global variables tracking position, last lightning strike
-global lastStrikeTime, lastStrikeDist
 
+#global variable tracking position
 #default position is Pensacola, FL
 class LocationInfo():
     
@@ -44,67 +88,95 @@ class LocationInfo():
         self.longitude = "-81.60" 
         self.locationstr = "Jacksonville, FL, USA"
         
+        self.refresh_location_context()
+        
+    #recomputes everything derived from the position: time zone and a year of sunrise/sunset times
+    def refresh_location_context(self):
+        self.context_position = (float(self.latitude), float(self.longitude))
         self.timezone = self.get_time_zone()
-        self.sun_times = self.get_sun_times()
+        self.tzinfo = tz.gettz(self.timezone)
+        self.sun_calendar_start, self.sun_calendar = self.get_sun_calendar()
+        self.refresh_sun_times()
     
     def get_time_zone(self):
-        tf = timezonefinder.TimezoneFinder()
-        return tf.certain_timezone_at(lat=float(self.latitude), lng=float(self.longitude))
+        return get_timezone_finder().certain_timezone_at(lat=float(self.latitude), lng=float(self.longitude))
     
+    #today's [sunrise, sunset] (naive UTC), looked up in the precomputed calendar
     def refresh_sun_times(self):
-        self.sun_times = self.get_sun_times()
+        today = datetime.utcnow()
+        if (today.date() - self.sun_calendar_start).days >= len(self.sun_calendar) - 1: #calendar used up- start a new year
+            self.sun_calendar_start, self.sun_calendar = self.get_sun_calendar()
+        self.sun_times = self.sun_times_for(today)
+        
+    def sun_times_for(self, date):
+        day = (date.date() - self.sun_calendar_start).days
+        if day < 0 or day >= len(self.sun_calendar): #outside the calendar (e.g. old backfilled observations)
+            return self.get_sun_times(Sun(float(self.latitude), float(self.longitude)), date.date())
+        return self.sun_calendar[day]
         
-    def get_sun_times(self):
+    #[sunrise, sunset] (naive UTC) for sun_calendar_days days starting yesterday
+    def get_sun_calendar(self):
+        startdate = datetime.utcnow().date() - timedelta(days=1)
         sun = Sun(float(self.latitude), float(self.longitude))
-        return [sun.get_sunrise_time().replace(tzinfo=None), sun.get_sunset_time().replace(tzinfo=None)]
-    
-    def parse_geolocator():
-        outputstr = ""
-        l = self.loc.raw['address']
-    
-        p1 = "none"
-        priority = ['city','town','village','county','hamlet','suburb','neighborhood','road']
-        for item in priority:
-            if item in l:
-                outputstr += l[item] + ", "
-                p1 = item
-                break
-        
-        priority = ['state','state-district','province']
-        if p1.lower() != 'county':
-            priority.append('county')
-        for item in priority:
-            if item in l:
-                outputstr += l[item]
-                break
-        
-        if l['country'].lower() != 'united states':
-            outputstr += ", " + l['country']
-            
-        return outputstr 
-    
+        return startdate, [self.get_sun_times(sun, startdate + timedelta(days=day)) for day in range(sun_calendar_days)]
+        
+    def get_sun_times(self, sun, date):
+        try:
+            return [sun.get_sunrise_time(date).replace(tzinfo=None), sun.get_sunset_time(date).replace(tzinfo=None)]
+        except SunTimeException: #polar day/night- no sunrise or sunset
+            return [datetime.combine(date, datetime.min.time())]*2
     
-    def update(self, latitude, longitude):
+    def update(self, latitude, longitude, locationstr=None):
+        float(latitude), float(longitude) #ValueError for bad input before any state changes
         self.latitude = latitude
         self.longitude = longitude
         
-        geolocator = Nominatim(user_agent="geoapiExercises")
-        self.loc = geolocator.reverse(f"{self.latitude},{self.longitude}", language="en")
-        self.locationstr = self.parse_geolocator()
+        #place name comes from the geocoder cache, or later from the background lookup (pages show lat/lon until then)
+        if locationstr is None:
+            locationstr = reverseGeocoder.lookup(latitude, longitude) or ""
+        self.locationstr = locationstr
         
-        self.timezone = self.get_time_zone()
-        self.sun_times = self.get_sun_times()
+        #time zone/sun times only change noticeably if the station moved
+        if distance_km(self.context_position, (float(latitude), float(longitude))) >= relocation_distance_km:
+            self.refresh_location_context()
         
 
+#days of sunrise/sunset times precomputed, and how far the station must move (km) before they are recomputed
+sun_calendar_days = 366
+relocation_distance_km = 10
+
+#TimezoneFinder loads a large polygon dataset, so one instance is kept for the life of the process
+global timezoneFinder
+timezoneFinder = None
+
+def get_timezone_finder():
+    global timezoneFinder
+    if timezoneFinder is None:
+        timezoneFinder = timezonefinder.TimezoneFinder()
+    return timezoneFinder
+    
+    
+#great circle distance between two (lat, lon) positions
+def distance_km(position1, position2):
+    lat1, lon1, lat2, lon2 = np.deg2rad([*position1, *position2])
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*6371*np.arcsin(np.sqrt(a))
         
         
-global locationInfo
-locationInfo = LocationInfo()
+#called by the geocoder thread when a place name arrives (ignored if the station has moved on since)
+def set_location_name(latitude, longitude, locationstr):
+    if (latitude, longitude) == (locationInfo.latitude, locationInfo.longitude):
+        locationInfo.locationstr = locationstr
+        with writeSession.begin() as session:
+            store_location(session)
+        responseCache.invalidate()
+        publish_event('location', location_event())
+        
+reverseGeocoder = ReverseGeocoder(os.path.join(app.instance_path, 'geocache.json'), set_location_name)
 
-#default strike time = LONG ago, distance = FAR away
-lastStrikeTime = datetime(1,1,1)
-lastStrikeDist = 1000
 
+global locationInfo
+locationInfo = LocationInfo()
 
 
 
@@ -116,7 +188,7 @@ lastStrikeDist = 1000
 #to initialize database, from cmd line do "from app import db", then "db.create_all()"
 class wxobs(db.Model): #class for weather observations database
     id = db.Column(db.Integer, primary_key=True) #primary key for database
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True, unique=True) #every route range-scans on date
     temp = db.Column(db.Float, nullable=False) 
     rh = db.Column(db.Float, nullable=False) 
     pres = db.Column(db.Float, nullable=False) 
@@ -126,62 +198,349 @@ class wxobs(db.Model): #class for weather observations database
     precip = db.Column(db.Float, nullable=False)
     solar = db.Column(db.Float, nullable=False)
     strikes = db.Column(db.Float, nullable=False)
+    qcflags = db.Column(db.Integer, nullable=False, default=0) #QC_BITS of the variables that failed quality control (see qc.py)
+    
+    #derived quantities (see derived.py), computed when observations are stored- NULL where undefined
+    dewpoint = db.Column(db.Float) #C
+    heat_index = db.Column(db.Float) #C
+    wind_chill = db.Column(db.Float) #C
+    feels_like = db.Column(db.Float) #C
+    pres_msl = db.Column(db.Float) #mb
+    pres_tendency = db.Column(db.Float) #mb change over 3 hours
+    rain_1h = db.Column(db.Float) #mm
+    rain_24h = db.Column(db.Float) #mm
     
     def __repr__(self): #keyword function for everytime the database is updated
         return f'Entry {self.id}: {self.date.strftime("%y%m%d %H:%M:%S")}'
+
         
+#hourly/daily count/min/max/sum rollups of the values in wxobs that passed quality control, updated by /addnewob and rebuilt by gendb.py
+wxobs_hourly = rollup_model(db, 'wxobs_hourly')
+wxobs_daily = rollup_model(db, 'wxobs_daily')
+
+#lightning strike reports
+class wxstrikes(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.DateTime, nullable=False, index=True)
+    distance = db.Column(db.Float, nullable=False) #km
+    
+    
+#key/value metadata about the observation table (earliest/latest observation dates)
+class wxmeta(db.Model):
+    key = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.String(64), nullable=False)
+    
+    
+#version counters of the state shared by all worker processes (see sharedstate.py)
+class wxchanges(db.Model):
+    topic = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+with app.app_context():
+    db.create_all() #adds any missing tables (e.g. rollups) to an existing database, run migratedb.py for indexes
+    if not dict((row[1], row[2]) for row in db.session.execute(text("PRAGMA index_list(wxobs)"))).get('ix_wxobs_date'):
+        print("wxobs.date has no unique index (observations could be stored twice)- run migratedb.py")
+    
+    #older databases get the QC and derived columns empty (migratedb.py --qc --derived fills them in)
+    newcolumns = dict({var:'FLOAT' for var in DERIVED_VARS}, qcflags='INTEGER NOT NULL DEFAULT 0')
+    with writeSession.begin() as session: #checked inside the write lock, since workers start together
+        existing = {row[1] for row in session.execute(text("PRAGMA table_info(wxobs)"))}
+        for name, definition in newcolumns.items():
+            if name not in existing:
+                session.execute(text(f"ALTER TABLE wxobs ADD COLUMN {name} {definition}"))
+                
+                
+#rollup tables from before quality control are neither read nor updated until migratedb.py recreates them
+#(checked again until then, so running workers pick the new tables up without a restart)
+global rollupsReady
+rollupsReady = False
+
+def rollups_ready(session):
+    global rollupsReady
+    if not rollupsReady:
+        rollupsReady = rollups_current(session)
+    return rollupsReady
+    
+with app.app_context():
+    if not rollups_ready(db.session):
+        print("[rollups] tables predate quality control- run migratedb.py to rebuild them (long ranges are read from wxobs until then)")
+    
+    
+#topics: "location" (position/place name in wxmeta), "observations" (wxobs), "strikes" (wxstrikes)
+global changeNotifier
+changeNotifier = ChangeNotifier('wxchanges')
+
+with app.app_context():
+    changeNotifier.poll(db.session, force=True) #versions of the state about to be loaded
+    
+    
+#station position is shared through wxmeta so every worker (and a restarted server) uses the latest /updateGPS
+def store_location(session):
+    for key in ['latitude','longitude','locationstr']:
+        session.merge(wxmeta(key=key, value=getattr(locationInfo, key)))
+    changeNotifier.publish(session, 'location')
+    
+def location_event():
+    return {'latitude': locationInfo.latitude, 'longitude': locationInfo.longitude, 'locationstr': locationInfo.locationstr}
+    
+def load_location():
+    with app.app_context():
+        meta = {row.key:row.value for row in wxmeta.query.filter(wxmeta.key.in_(['latitude','longitude','locationstr']))}
+    if len(meta) == 3:
+        locationInfo.update(meta['latitude'], meta['longitude'], meta['locationstr'])
         
-#stores dataset as individual lists of time series AND as list of individual observations 
-class ObservationList():
-    def __init__(self, date, temp, rh, pres, wspd, wgust, wdir, precip, solar, strikes):
-        self.date = date
-        self.temp = temp
-        self.rh = rh
-        self.pres = pres
-        self.wspd = wspd
-        self.wgust = wgust
-        self.wdir = wdir
-        self.precip = precip
-        self.solar = solar
-        self.strikes = strikes
-    
-        
-#returns an ObservationList containing the data
-def parsedboutput(obs):
-    date = []
-    temp = []
-    rh = []
-    pres = []
-    wspd = []
-    wgust = []
-    wdir = []
-    precip = []
-    solar = []
-    strikes = []
-    
-    fromzone = tz.gettz('UTC')
-    tozone = tz.gettz(locationInfo.timezone)
+load_location()
+    
+
+#cached first/last observation dates (naive UTC), kept in wxmeta so they never require a table scan
+global dateBounds
+dateBounds = None
+
+def get_date_bounds():
+    global dateBounds
+    
+    if dateBounds is None:
+        with app.app_context():
+            meta = {row.key:row.value for row in wxmeta.query.filter(wxmeta.key.in_(['earliest','latest']))}
+            if len(meta) == 2:
+                dateBounds = [datetime.fromisoformat(meta['earliest']), datetime.fromisoformat(meta['latest'])]
+            else:
+                with writeSession.begin() as session:
+                    dateBounds = refresh_date_bounds(session)
+                
+    return dateBounds
+    
+    
+#recomputes the date bounds with min()/max() on the indexed date column and stores them in wxmeta (caller commits)
+def refresh_date_bounds(session):
+    earliest, latest = session.execute(select(func.min(wxobs.date), func.max(wxobs.date))).first()
+    if earliest is None: #empty database
+        earliest = latest = datetime.utcnow()
+    store_date_bounds(session, [earliest, latest])
+    return dateBounds
+    
+    
+#widens the date bounds to include new observation date(s) (caller commits)
+def extend_date_bounds(session, *dates):
+    bounds = get_date_bounds()
+    newbounds = [min(bounds[0], *dates), max(bounds[1], *dates)]
+    if newbounds != bounds:
+        store_date_bounds(session, newbounds)
+        
+        
+def store_date_bounds(session, bounds):
+    global dateBounds
+    dateBounds = bounds
+    for key, value in zip(['earliest','latest'], bounds):
+        session.merge(wxmeta(key=key, value=value.isoformat()))
+        
+#loaded at startup- refreshing them lazily from the observation writer would wait on the writer's own connection
+get_date_bounds()
+        
+        
+#column store replica of wxobs when OBS_BACKEND is 'colstore'
+global obStore
+obStore = ColumnStore(app.config['COLSTORE_PATH']) if app.config['OBS_BACKEND'] == 'colstore' else None
+if obStore is not None and len(obStore) == 0 and get_date_bounds()[0] < get_date_bounds()[1]:
+    print("[colstore] store is empty- run colstore.py to copy the existing observations into it")
+    
+    
+#returns an ObservationArrays containing all observations in [startdate, enddate] (UTC) from a single SELECT
+#(or from views of the column store), if target (number of points) is given, reads the coarsest rollup table
+#that still resolves the range that finely
+@instrumentation.timed('query')
+def query_observations(startdate=None, enddate=None, descending=False, limit=None, target=None):
+    
+    tzinfo = locationInfo.tzinfo
+    
+    if target and startdate and enddate:
+        rollup = choose_rollup(startdate, enddate, target)
+        if rollup:
+            with app.app_context():
+                if rollups_ready(db.session):
+                    return query_rollup(db.session, rollup, startdate, enddate, tzinfo, descending)
+                
+    if obStore is not None:
+        start, end = [utc_epoch(date) if date else None for date in (startdate, enddate)]
+        return obStore.observations(start, end, tzinfo, descending, limit)
+    
+    return ObservationArrays.from_rows(select_observation_rows(startdate, enddate, descending, limit), tzinfo)
+    
+    
+#a wxobs variable as NULL where quality control flagged it (NaN once in an array)
+def masked_column(var):
+    return case((wxobs.qcflags.op('&')(QC_BITS[var]) != 0, None), else_=getattr(wxobs, var))
+    
+#(epoch, temp, rh, pres, ...) rows in raw wxobs units, masked by QC unless raw (which adds a qcflags column)
+def select_observation_rows(startdate=None, enddate=None, descending=False, limit=None, raw=False):
+    
+    if raw:
+        columns = [cast(func.strftime('%s', wxobs.date), Integer)] + [getattr(wxobs, var) for var in OB_VARS] + [wxobs.qcflags]
+    else:
+        columns = [cast(func.strftime('%s', wxobs.date), Integer)] + [masked_column(var) for var in OB_VARS]
+    query = select(*columns)
+    if startdate:
+        query = query.where(wxobs.date >= startdate)
+    if enddate:
+        query = query.where(wxobs.date <= enddate)
+    query = query.order_by(wxobs.date.desc() if descending else wxobs.date) #ordered by the date index, so no sort step
+    if limit:
+        query = query.limit(limit)
     
     with app.app_context():
-        for entry in obs:
-            date.append(replacetimezone(entry.date,fromzone,tozone)) #local time
-            temp.append(entry.temp) #convert to F
-            rh.append(entry.rh)
-            pres.append(entry.pres)
-            wspd.append(entry.wspd)
-            wgust.append(entry.wgust)
-            wdir.append(entry.wdir)
-            precip.append(entry.precip)
-            solar.append(entry.solar)
-            strikes.append(entry.strikes)
+        return db.session.execute(query).all()
+        
+        
+        
+#rows per table page on /historical
+table_page_size = 100
+table_max_page_size = 1000
+
+#one page of observations in [startdate, enddate], sorted by the database on the date index
+#pages are keyed by the last row's "epoch:id" (cursor) so each page is an index range scan, not an OFFSET
+@instrumentation.timed('query')
+def query_table_page(startdate, enddate, limit, descending=True, cursor=None):
+    
+    epoch = cast(func.strftime('%s', wxobs.date), Integer)
+    query = select(wxobs.id, epoch, *[masked_column(var) for var in OB_VARS]).where((wxobs.date >= startdate) & (wxobs.date <= enddate))
+    
+    if cursor:
+        cepoch, cid = [int(value) for value in cursor.split(':')]
+        cdate = datetime.utcfromtimestamp(cepoch)
+        if descending: #earlier seconds, or the cursor's second with a smaller id
+            query = query.where(wxobs.date < cdate + timedelta(seconds=1)).where((wxobs.date < cdate) | ((epoch == cepoch) & (wxobs.id < cid)))
+        else:
+            query = query.where(wxobs.date >= cdate).where((wxobs.date >= cdate + timedelta(seconds=1)) | ((epoch == cepoch) & (wxobs.id > cid)))
             
-    tempF = [(t*9/5 + 32) for t in temp]
+    if descending:
+        query = query.order_by(wxobs.date.desc(), wxobs.id.desc())
+    else:
+        query = query.order_by(wxobs.date, wxobs.id)
+        
+    with app.app_context():
+        rows = db.session.execute(query.limit(limit + 1)).all() #one extra row tells whether another page exists
+        
+    nextcursor = f"{rows[limit-1][1]}:{rows[limit-1][0]}" if len(rows) > limit else None
+    return ObservationArrays.from_rows([row[1:] for row in rows[:limit]], locationInfo.tzinfo), nextcursor
+    
+    
+    
+#seconds since 1970-01-01 for a naive UTC datetime
+def utc_epoch(date):
+    return calendar.timegm(date.timetuple())
+    
+    
     
-    ob_list = []
-    for cdate,ctemp,crh,cpres,cwspd,cwgust,cwdir,cprecip,csolar,cstrikes in zip(date, tempF, rh, pres, wspd, wgust, wdir, precip, solar, strikes):
-        ob_list.append(ObservationList(cdate,ctemp,crh,cpres,cwspd,cwgust,cwdir,cprecip,csolar,cstrikes))
+#the most recent observations are kept in memory so /current and /currentdata don't query the database
+recent_window = 86400 #seconds of observations loaded at startup
+recent_capacity = 2880 #observations kept (two days at one-minute cadence)
+recent_plot_points = 240 #minimum points kept in the live /current plot (4 hours at one-minute cadence)
+
+global recentObs
+recentObs = ObservationRing(recent_capacity)
+
+def load_recent_obs():
+    start = int(time.time()) - recent_window
+    rows = select_observation_rows(datetime.utcfromtimestamp(start), descending=True, limit=recent_capacity, raw=True)
+    if len(rows) == 0: #station offline for a while- keep at least the latest observation
+        rows = select_observation_rows(descending=True, limit=1, raw=True)
+    recentObs.merge(rows, start) #keeps this worker's queued observations that aren't written yet
+    
+load_recent_obs()
+
+
+#strikes are read by id, so each call only returns strikes reported (by any worker) since the last one, and only
+#those recent enough for live events and the strike alert rules (the wxstrikes table keeps the full history)
+global lastStrikeId
+lastStrikeId = 0
+strikeLock = threading.Lock()
+recent_strike_seconds = 3600
+
+def load_recent_strikes():
+    global lastStrikeId
+    window = max([recent_strike_seconds] + [rule.window for rule in alertEngine.rules if rule.var == 'strike'])
+    cutoff = datetime.utcnow() - timedelta(seconds=window)
+    newstrikes = []
+    with strikeLock, app.app_context():
+        query = select(wxstrikes.id, wxstrikes.date, wxstrikes.distance).where((wxstrikes.id > lastStrikeId) & (wxstrikes.date >= cutoff)).order_by(wxstrikes.id)
+        for strikeid, date, distance in db.session.execute(query):
+            newstrikes.append((utc_epoch(date), distance))
+            lastStrikeId = strikeid
+    return newstrikes #(epoch, km) of the new strikes
             
-    return ob_list
+
+
+#alert rules (see alerts.py) are fed every observation and strike this process ingests or picks up from
+#other workers, and primed at startup with the buffered ones
+alertEngine = AlertEngine(app.config['ALERT_RULES'])
+
+#ObservationArrays of new observations (temp in F, as the rules are written)
+def observe_alerts(newobs):
+    publish_alerts(alertEngine.observe_many(newobs.epoch, {var:getattr(newobs, var) for var in alertEngine.var_statistics if var in OB_VARS}))
+    
+#(epoch, km) of new strikes
+def observe_strikes(strikes):
+    for epoch, distance in strikes:
+        publish_alerts(alertEngine.observe(epoch, {'strike': distance}))
+        
+#live event for each alert that becomes active (see asgi.py)
+def publish_alerts(alerts):
+    for alert in alerts:
+        publish_event('alert', alert)
+        
+#alerts active now: [{"name", "message", "value", "since"}]
+def active_alerts():
+    return alertEngine.active(int(time.time()))
+    
+def lightning_active():
+    return any(alert['name'] == 'lightning' for alert in active_alerts())
+    
+observe_alerts(recentObs.since(0, locationInfo.tzinfo)[::-1])
+observe_strikes(load_recent_strikes())
+
+
+#most recent observation, from memory unless the buffer is empty
+def latest_observation():
+    lastob = recentObs.latest(locationInfo.tzinfo)
+    if len(lastob) == 0:
+        lastob = query_observations(descending=True, limit=1)
+    return lastob
+
+
+#derived quantities (see derived.py) for observations about to be added, using the buffered observations before them
+#for the rolling windows (call before adding them to recentObs)
+def derive_observations(epoch, columns):
+    history = recentObs.since(min(epoch) - history_seconds, locationInfo.tzinfo)
+    return derive(epoch, columns, (history.epoch, {'pres':history.pres, 'precip':history.precip}), app.config['STATION_ELEVATION_M'])
+    
+#{var: value or None} for observation i of derived arrays
+def derived_values(derived, i):
+    return {var:(None if np.isnan(values[i]) else float(values[i])) for var,values in derived.items()}
+    
+    
+#derived quantities of the most recent observation (temperatures in F), set when it is ingested here
+#or read from wxobs once the observation writer has stored it (e.g. uploads to another worker)
+global latestDerived
+latestDerived = {}
+
+def set_latest_derived(epoch, values):
+    global latestDerived
+    latestDerived = {var:(c_to_f(value) if var in DERIVED_TEMPS and value is not None else value) for var,value in values.items()}
+    latestDerived['epoch'] = epoch
+    
+def latest_derived():
+    lastob = latest_observation()
+    if len(lastob) == 0:
+        return dict.fromkeys(DERIVED_VARS)
+    epoch = int(lastob.epoch[0])
+    if latestDerived.get('epoch') != epoch:
+        with app.app_context():
+            query = select(*[getattr(wxobs, var) for var in DERIVED_VARS]).where(wxobs.date == datetime.utcfromtimestamp(epoch)).limit(1)
+            row = db.session.execute(query).first()
+        if row is None: #not written yet
+            return dict.fromkeys(DERIVED_VARS)
+        set_latest_derived(epoch, dict(zip(DERIVED_VARS, row)))
+    return latestDerived
 
 
         
@@ -193,24 +552,27 @@ def parsedboutput(obs):
 #default website link loads current conditions
 @app.route('/', methods=['POST','GET']) 
 @app.route('/current', methods=['POST','GET']) 
+@responseCache.cached(vary=lambda: user_on_mobile())
 def index():
     
-    global lastStrikeTime, lastStrikeDist, locationInfo
+    global locationInfo
     
     enddate = datetime.utcnow() #current date
     startdate = enddate - timedelta(hours=4)
     
     with app.app_context():
         
-        tableobs = parsedboutput(wxobs.query.order_by(-wxobs.id).filter(wxobs.date >= startdate)) #observations for plot/table
+        tableobs = recent_observations(startdate) #observations for plot/table
         
         is_mobile = user_on_mobile()
-        obsplot = observations_plot(tableobs, is_mobile) #building plot components given observations
+        obsplot = observations_plot(tableobs[::-1], is_mobile) #plot is oldest-first so new points can be streamed onto the end
         
         if len(tableobs) > 0:
-            lastob = tableobs[0] #most recent data point
+            lastob = tableobs.ob(0) #most recent data point
         else: #no data in table from last 4 hours
-            lastob = parsedboutput([wxobs.query.order_by(-wxobs.id).first()])[0]
+            lastob = latest_observation().ob(0)
+        cursor = int(lastob.date.timestamp()) #newest observation the page holds
+        rollover = max(len(tableobs), recent_plot_points) #points kept in the plot as new ones stream in
         
         #GPS position info
         if locationInfo.locationstr != "":
@@ -218,58 +580,144 @@ def index():
         else:
            gpstext = locationInfo.latitude + ", " + locationInfo.longitude 
         
-        #lightning strike info
-        lightningtext = False
-        timeSinceStrike = int(np.round((enddate - lastStrikeTime).total_seconds()/60)) #time since last strike report in minutes
-        if timeSinceStrike <= 30 and lastStrikeDist <= 30: #within 30 mins/30 km
-            lightningtext = f"Lightning detected {timeSinceStrike} minutes ago, {lastStrikeDist} km away"
+        alerts = active_alerts() #lightning, gusts...
+        
+        derived = latest_derived() #dewpoint, feels like, pressure tendency...
         
         #GET request- show content
-        return render_template('current.html',lastob=lastob, div_plot=obsplot, tableobs=tableobs, lightningtext=lightningtext, gpstext=gpstext) 
+        return render_template('current.html',lastob=lastob, derived=derived, div_plot=obsplot, tableobs=tableobs, alerts=alerts, gpstext=gpstext, cursor=cursor, rollover=rollover) 
+    
+    
+    
+#JSON of observations newer than the client's cursor (epoch seconds), oldest first, for streaming into the /current plot
+@app.route('/obsdata', methods=['GET'])
+def obsdata():
+    
+    try:
+        since = int(request.args.get('since', 0))
+        sincedate = datetime.utcfromtimestamp(since + 1)
+    except (ValueError, OverflowError, OSError): #not a number, or outside the dates datetime/the platform can represent
+        return "INVALID_CURSOR", 400
+        
+    startdate = max(sincedate, datetime.utcnow() - timedelta(hours=4)) #never more than the /current window
+    newobs = recent_observations(startdate)[::-1]
+    
+    return {"cursor": int(newobs.epoch[-1]) if len(newobs) > 0 else since, "data": newobs.json_data()}
+    
+    
+    
+#observations since startdate (UTC), newest first, from memory when the ring buffer holds them all
+@instrumentation.timed('query')
+def recent_observations(startdate):
+    tzinfo = locationInfo.tzinfo
+    if recentObs.covers(utc_epoch(startdate)):
+        return recentObs.since(utc_epoch(startdate), tzinfo)
+    return query_observations(startdate, descending=True)
     
 
     
 #route for historical observations #TODO: ADD QUERY BY DATE
 @app.route('/historical', methods=['POST','GET']) #create index route so it doesn't ERROR 404
+@responseCache.cached(vary=lambda: user_on_mobile())
 def historical():
     
     with app.app_context():
         
         #parsing input arguments 
-        if request.method == 'GET':
-            startdate = parsedatestr(request.args.get('start',False))
-            enddate = parsedatestr(request.args.get('end',False))
-        elif request.method == 'POST':
-            startdate = parsedatestr(request.form['start'])
-            enddate = parsedatestr(request.form['end'])
+        if request.method == 'POST':
+            startdate, enddate = parse_date_range(request.form)
         else:
-            startdate = False
-            enddate = False
-                
-        #if one date missing- return 14 day window. If both missing, return 14 day window from present 
-        if not startdate and not enddate:
-            enddate = datetime.utcnow()
-            startdate = enddate - timedelta(days=14)
-        elif not startdate:
-            startdate = enddate - timedelta(days=14)
-        elif not enddate:
-            enddate = startdate + timedelta(days=14)
-        elif startdate == enddate:
-            startdate -= timedelta(days=1)
-            enddate += timedelta(days=1)
+            startdate, enddate = parse_date_range(request.args)
                 
         #pulling observations
         is_mobile = user_on_mobile()
-        tableobs = parsedboutput(wxobs.query.order_by(wxobs.id).filter((wxobs.date >= startdate) & (wxobs.date <= enddate))) #observations for plot/table
+        target = target_points(startdate, enddate, is_mobile)
+        plotobs = query_observations(startdate, enddate, target=target) #observations for plot
+        with instrumentation.span('decimate'):
+            plotobs = decimate(plotobs, target) #bounded point count for long ranges
+        
+        obsplot = observations_plot(plotobs, is_mobile) #building plot components given observations
         
-        obsplot = observations_plot(tableobs, is_mobile) #building plot components given observations
+        #first page of the table, newest first (more pages are fetched by the browser from /historical/table)
+        tableobs, cursor = query_table_page(startdate, enddate, table_page_size, descending=True)
+        tablerange = {'start':startdate.strftime("%Y%m%d%H%M%S"), 'end':enddate.strftime("%Y%m%d%H%M%S"), 'cursor':cursor}
         
         #pulling date constraints for date selection tool
         dates = {}
-        dates['startdate'] = wxobs.query.order_by(wxobs.id).first().date.strftime("%Y-%m-%d")
-        dates['enddate'] = wxobs.query.order_by(-wxobs.id).first().date.strftime("%Y-%m-%d")
+        earliest, latest = get_date_bounds()
+        dates['startdate'] = earliest.strftime("%Y-%m-%d")
+        dates['enddate'] = latest.strftime("%Y-%m-%d")
+        
+        return render_template('historical.html', div_plot=obsplot, tableobs=tableobs, tablerange=tablerange, dates=dates) #GET request- show content
+    
+    
+    
+#one page of table rows for /historical as JSON {"rows": html, "cursor": next page cursor or null}
+#args: start, end, order (asc/desc), cursor (from the previous page), limit
+@app.route('/historical/table', methods=['GET'])
+def historicaltable():
+    
+    startdate, enddate = parse_date_range(request.args)
+    descending = request.args.get('order', 'desc') != 'asc'
+    try:
+        limit = max(1, min(int(request.args.get('limit', table_page_size)), table_max_page_size))
+        tableobs, cursor = query_table_page(startdate, enddate, limit, descending, request.args.get('cursor'))
+    except ValueError:
+        return "INVALID_CURSOR", 400
         
-        return render_template('historical.html', div_plot=obsplot, tableobs=tableobs, dates=dates) #GET request- show content
+    return {"rows": render_template('obsrows.html', tableobs=tableobs), "cursor": cursor}
+    
+    
+    
+#bulk download of raw observations: args start, end (as /historical) and format (csv, nc, or parquet if pyarrow is installed)
+@app.route('/export', methods=['GET'])
+def export():
+    
+    startdate, enddate = parse_date_range(request.args)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORTERS:
+        return "UNSUPPORTED_FORMAT", 400
+        
+    exporter, mimetype = EXPORTERS[fmt]
+    filename = f"wxobs_{startdate.strftime('%Y%m%d%H%M%S')}_{enddate.strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return Response(exporter(export_batches(startdate, enddate)), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+    
+    
+#reads observations in [startdate, enddate] in export_batch_size batches as (epoch, {var: array}) in raw wxobs units
+export_batch_size = 10000
+
+def export_batches(startdate, enddate):
+    
+    query = select(cast(func.strftime('%s', wxobs.date), Integer), *[masked_column(var) for var in OB_VARS]) #QC-flagged values are NaN
+    query = query.where((wxobs.date >= startdate) & (wxobs.date <= enddate)).order_by(wxobs.date)
+    
+    with app.app_context(): #runs while the response is being sent, after the request has returned
+        with db.engine.connect() as connection:
+            result = connection.execution_options(yield_per=export_batch_size).execute(query)
+            for rows in result.partitions():
+                data = rows_array(rows, len(OB_VARS) + 1)
+                yield data[:,0].astype(np.int64), {var:data[:,i+1] for i,var in enumerate(OB_VARS)}
+                
+                
+                
+#start/end dates (naive UTC) from request arguments: if one date missing- 14 day window, if both missing- 14 day window from present
+def parse_date_range(args):
+    
+    startdate = parsedatestr(args.get('start',False))
+    enddate = parsedatestr(args.get('end',False))
+    
+    if not startdate and not enddate:
+        enddate = datetime.utcnow()
+        startdate = enddate - timedelta(days=14)
+    elif not startdate:
+        startdate = enddate - timedelta(days=14)
+    elif not enddate:
+        enddate = startdate + timedelta(days=14)
+    elif startdate == enddate:
+        startdate -= timedelta(days=1)
+        enddate += timedelta(days=1)
+        
+    return startdate, enddate
     
     
     
@@ -282,33 +730,22 @@ def piwxoverview():
 
 #API-style request for JSON data (for Magic Mirror), mimics OpenWeatherMap API for CurrentWeather Module
 @app.route('/currentdata', methods=['POST','GET'])
+@responseCache.cached(vary=lambda: user_on_mobile())
 def currentdata():
     
-    global locationInfo, lastStrikeTime, lastStrikeDist
+    global locationInfo
     locationInfo.refresh_sun_times()
     
-    #get most recent data point
-    with app.app_context():
-        lastob = parsedboutput([wxobs.query.order_by(-wxobs.id).first()])[0]
+    #get most recent data point and its derived quantities
+    lastob = latest_observation().ob(0)
+    derived = latest_derived()
     
     cdate = datetime.utcnow()
-    timeSinceStrike = int(np.round((cdate - lastStrikeTime).total_seconds()/60)) #time since last strike report in minutes
-    
-    #determining icon to send
-    if timeSinceStrike <= 30 and lastStrikeDist <= 30: #lightning within 30 km and 30 min = thunderstorm
-        num = "11"
-    elif lastob.precip >= 0: #rainfall > 1mm/hr recorded
-        if lastob.temp > 32: #rain
-            num = "10"
-        else:
-            num = "13" #snow
-    elif lastob.wgust > 10: #windy
-        num = "04"
-    elif lastob.temp <= 60 and lastob.rh > 85: #foggy
-        num = "50"
-    else: 
-        num = "01" #sunny -TODO- distinguish sunny and cloudy
     
+    alerts = active_alerts()
+    
+    #icon: thunderstorm (lightning alert), rain/snow (> 1mm/hr), windy, foggy or sunny -TODO- distinguish sunny and cloudy
+    num = str(condition_codes(lastob.temp, lastob.rh, lastob.precip, lastob.wgust, any(alert['name'] == 'lightning' for alert in alerts)))
     
     if cdate >= locationInfo.sun_times[0] and cdate <= locationInfo.sun_times[1]: #between sunrise and sunset (daytime)
         dn = "d"
@@ -321,22 +758,35 @@ def currentdata():
     output = {"coord": {"lon": float(locationInfo.longitude),"lat": float(locationInfo.latitude)}, 
         "weather": [{"id": 0,"main": "not_used","description": "not_used","icon": wxicon}], #TODO
         "base": "stations", #TODO- fix "id" per API
-        "main": {"temp": lastob.temp,"feels_like": lastob.temp,"temp_min": lastob.temp, "temp_max":lastob.temp, "pressure":lastob.pres ,"humidity":lastob.rh, "sea_level":lastob.pres , "grnd_level":lastob.pres}, "visibility": 10000,
+        "main": {"temp": lastob.temp,"feels_like": fallback(derived['feels_like'], lastob.temp),"temp_min": lastob.temp, "temp_max":lastob.temp, "pressure":lastob.pres ,"humidity":lastob.rh, "dew_point": derived['dewpoint'], "sea_level":fallback(derived['pres_msl'], lastob.pres), "grnd_level":lastob.pres}, "visibility": 10000,
         "wind": {"speed": lastob.wspd,"deg": lastob.wdir,"gust": lastob.wgust},
-        "rain": {"1h": lastob.precip},
+        "rain": {"1h": fallback(derived['rain_1h'], lastob.precip)},
         "clouds": {"all": 0},
         "dt": round(lastob.date.timestamp()),
         "sys": {"type": 1,"id": 1,"country": "US","sunrise": round(locationInfo.sun_times[0].timestamp()), "sunset": round(locationInfo.sun_times[0].timestamp())}, 
-        "timezone": -14400, "id": 0000000, "name": locationInfo.locationstr, "cod": 0} #TODO- fix timezone
+        "timezone": -14400, "id": 0000000, "name": locationInfo.locationstr, "cod": 0, #TODO- fix timezone
+        "alerts": [{"event": alert['name'], "description": alert['message'], "start": alert['since']} for alert in alerts]} #as in OpenWeatherMap One Call
         
-    htmloutput = "<html>\n<head></head>\n<body><pre>" + json.dumps(output) + "</pre><div></div></body></html>"
+    htmloutput = "<html>\n<head></head>\n<body><pre>" + json.dumps(json_safe(output)) + "</pre><div></div></body></html>"
         
     return htmloutput
 
+
+def fallback(value, default):
+    return default if value is None else value
+    
+#null for NaN (values masked by quality control) anywhere in a JSON response
+def json_safe(value):
+    if isinstance(value, dict):
+        return {key:json_safe(item) for key,item in value.items()}
+    if isinstance(value, list):
+        return [json_safe(item) for item in value]
+    return None if isinstance(value, float) and np.isnan(value) else value
+
     
 def user_on_mobile() -> bool:
 
-    user_agent = request.headers.get("User-Agent")
+    user_agent = request.headers.get("User-Agent", "")
     user_agent = user_agent.lower()
     phones = ["android", "iphone"]
 
@@ -349,7 +799,17 @@ def user_on_mobile() -> bool:
 #routes to update database with new information
 #73d2be97af11e8ce2144cca61dc2749e643fa6d5 is SHA1 checksum for passphrase required (change this for your own site...)
 def validate_request(request):
-    return sha1(request.form['credential'].encode('utf-8')).hexdigest() == "73d2be97af11e8ce2144cca61dc2749e643fa6d5"
+    return validate_credential(request.form['credential'])
+    
+def validate_credential(credential):
+    return sha1(credential.encode('utf-8')).hexdigest() == "73d2be97af11e8ce2144cca61dc2749e643fa6d5"
+
+#POST field name for each observation variable
+OB_FIELDS = {'temp':'ta', 'rh':'rh', 'pres':'pres', 'wspd':'wspd', 'wgust':'wgust', 'wdir':'wdir', 'precip':'precip', 'solar':'solar', 'strikes':'strikes'}
+
+#column order of bulk CSV uploads (same as the station's 10-column WxO files)
+CSV_FIELDS = ['date', 'ta', 'rh', 'pres', 'wspd', 'wgust', 'wdir', 'solar', 'precip', 'strikes']
+
 
 #update regular observation (T/q/P/rain/wind/strikerate/solar)
 @app.route('/addnewob', methods=['POST'])
@@ -357,73 +817,247 @@ def addnewob():
     
     if validate_request(request):
         
-        with app.app_context():
-            
-            try:
-                cdate = parsedatestr(request.form['date'])
-                cta = request.form["ta"]
-                crh = request.form["rh"]
-                cpres = request.form["pres"]
-                cwspd = request.form["wspd"]
-                cwgust = request.form["wgust"]
-                cwdir = request.form["wdir"]
-                csolar = request.form["solar"]
-                cprecip = request.form["precip"]
-                cstrikes = request.form["strikes"]
-            except KeyError:
-                return "MISSING_POST_FIELD"
-                
-            #adding to database
-            lastID = wxobs.query.order_by(-wxobs.id).first().id
-            entry = wxobs(id=lastID + 1, date=cdate, temp=cta, rh=crh, pres=cpres, wspd = cwspd, wgust=cwgust, wdir = cwdir, precip=cprecip, solar=csolar, strikes=cstrikes)
-            db.session.add(entry)
-            db.session.commit()
+        try:
+            ob = parse_observation(request.form)
+        except KeyError:
+            return "MISSING_POST_FIELD"
+        except ValueError:
+            return "INVALID_POST_FIELD"
             
-            #updating top bar image
-            global locationInfo, lastStrikeTime, lastStrikeDist
-            timeSinceStrike = int(np.round((cdate - lastStrikeTime).total_seconds()/60)) #time since last strike report in minutes
-            locationInfo.refresh_sun_times()
-            if timeSinceStrike <= 30 and lastStrikeDist <= 30: #lightning within 30 km and 30 min
-                image = "thunderstorm"
-            elif float(cprecip) >= 1: #rainfall > 1mm/hr recorded
-                image = "rainyday"
-            elif abs((locationInfo.sun_times[1] - cdate).total_seconds()) <= 3600: #within an hour of sunset
-                image = "sunset"
-            elif cdate >= locationInfo.sun_times[0] and cdate <= locationInfo.sun_times[1]: #between sunrise and sunset (daytime)
-                image = "clearday"
-            else: #leaves nighttime, no rain/thunderstorm
-                image = "clearnight"
-                
-            #copy image if the current image is different
-            change_image(image)
+        ingest_observations([ob])
+        
+        #return success message to indicate data was added
+        return "SUCCESS"
+    else:
+        return "INVALID_CREDENTIAL"
+        
+        
+        
+#upload many observations at once (e.g. station backlog after an outage): the "data" field holds
+#either CSV lines in CSV_FIELDS order or JSON lines with the same keys as /addnewob
+@app.route('/addnewobs', methods=['POST'])
+def addnewobs():
+    
+    if validate_request(request):
+        
+        try:
+            lines = [line.strip() for line in request.form['data'].splitlines() if line.strip()]
+            if lines and lines[0].startswith('{'):
+                obs = [parse_observation(json.loads(line)) for line in lines]
+            else:
+                obs = [parse_observation(dict(zip(CSV_FIELDS, line.split(',')))) for line in lines]
+        except KeyError:
+            return "MISSING_POST_FIELD"
+        except ValueError: #includes json.JSONDecodeError
+            return "INVALID_POST_FIELD"
             
-            #return success message to indicate data was added
-            return "SUCCESS"
+        if obs:
+            ingest_observations(obs)
+        
+        return f"SUCCESS {len(obs)}"
     else:
         return "INVALID_CREDENTIAL"
+        
+        
+        
+#(date, {var:value}) for one set of POST/JSON/CSV fields, raising KeyError/ValueError for missing/bad fields
+#(including nan/inf, which the NOT NULL wxobs columns can't store)
+def parse_observation(fields):
+    cdate = parsedatestr(str(fields['date']))
+    if not cdate:
+        raise ValueError(f"invalid date {fields['date']}")
+    values = {var:float(fields[field]) for var,field in OB_FIELDS.items()}
+    if not all(math.isfinite(value) for value in values.values()):
+        raise ValueError(f"non-finite value in observation at {fields['date']}")
+    return cdate, values
+    
+    
+    
+#makes new observations visible immediately (memory), queues the database write,
+#and updates derived state (header image) once for the whole set
+@instrumentation.timed('ingest')
+def ingest_observations(obs):
+    
+    obs = unbuffered_observations(obs)
+    if not obs:
+        return
+    epoch = np.array([utc_epoch(cdate) for cdate,_ in obs], dtype=np.int64)
+    columns = {var:np.array([values[var] for _,values in obs], dtype=np.float64) for var in OB_VARS}
+    flags = qc_recent_observations(epoch, columns)
+    derived = derive_observations(epoch, mask_flagged(columns, flags)) #stored with the observations, so pages never recompute them
+    obs = [(cdate, dict(values, qcflags=int(flags[i]), **derived_values(derived, i))) for i,(cdate,values) in enumerate(obs)]
+    newest = int(np.argmax(epoch))
+    if epoch[newest] >= max(recentObs.latest(locationInfo.tzinfo).epoch, default=0):
+        set_latest_derived(int(epoch[newest]), derived_values(derived, newest))
+    recentObs.extend(epoch, columns, flags)
+    obWriter.submit(obs)
+    order = np.argsort(epoch, kind='stable')
+    newobs = ObservationRing.masked(epoch[order], {var:values[order] for var,values in columns.items()}, flags[order], locationInfo.tzinfo)
+    observe_alerts(newobs)
+    if eventListeners:
+        publish_observations(newobs)
+    
+    latestdate, latestvalues = max(obs, key=lambda ob: ob[0])
+    update_header_image(latestdate, latestvalues['precip'])
+    responseCache.invalidate()
+    
+    
+    
+#obs without repeated dates or dates already in the ring buffer (e.g. a station resending its backlog)
+def unbuffered_observations(obs):
+    known = set(recentObs.window(min(utc_epoch(cdate) for cdate,_ in obs))[0].tolist()) if obs else set()
+    new = {}
+    for cdate, values in obs:
+        if utc_epoch(cdate) not in known:
+            new.setdefault(cdate, values)
+    return list(new.items())
+    
+    
+    
+#qcflags for new observations (epoch and raw column arrays), checked together with the buffered observations
+#around them. Buffered observations whose flags change (a spike is only recognisable once the next observation
+#has arrived) are updated in memory, and in the database through the observation writer.
+def qc_recent_observations(epoch, columns):
+    
+    windowepoch, windowcolumns, windowflags = recentObs.window(int(epoch.min()) - qc_history_seconds)
+    n = len(windowepoch)
+    flags = qc_flags(np.concatenate((windowepoch, epoch)), {var:np.concatenate((windowcolumns[var], columns[var])) for var in OB_VARS})
+    
+    recheck = windowflags | flags[:n] #earlier observations only gain flags (see qc.py)
+    changed = np.flatnonzero(recheck != windowflags)
+    if len(changed) > 0:
+        recentObs.set_flags(windowepoch[changed], recheck[changed])
+        obWriter.submit([(datetime.utcfromtimestamp(int(windowepoch[i])), {'qcflags': int(recheck[i])}) for i in changed])
+    return flags[n:]
+    
+    
+    
+#writes a batch of observations in one transaction (called from the ObservationWriter thread)
+#entries holding only qcflags update the flags of an observation already submitted
+@instrumentation.timed('write')
+def write_observations(obs):
+    
+    updates = [{'cdate': cdate, 'flags': values['qcflags']} for cdate,values in obs if set(values) == {'qcflags'}]
+    obs = [(cdate, values) for cdate,values in obs if set(values) != {'qcflags'}]
+    
+    with writeSession.begin() as session:
+        obs = unstored_observations(session, obs)
+        dates = [cdate for cdate,_ in obs]
+        masked = mask_flagged({var:[values[var] for _,values in obs] for var in OB_VARS}, [values['qcflags'] for _,values in obs])
+        rollups = rollups_ready(session)
+        if obs: #OR IGNORE: the unique date index is the last line of defence against duplicates
+            session.execute(insert(wxobs).prefix_with('OR IGNORE'), [dict(date=cdate, **values) for cdate,values in obs]) #ids assigned by SQLite
+            if rollups:
+                update_rollups(session, [utc_epoch(cdate) for cdate in dates], masked)
+            extend_date_bounds(session, *dates)
+        if updates: #after the inserts, which may include the observations being updated
+            session.connection().execute(update(wxobs).where(wxobs.date == bindparam('cdate')).values(qcflags=bindparam('flags')), updates)
+            if rollups: #newly flagged values leave the rollups
+                rebuild_buckets(session, [utc_epoch(change["cdate"]) for change in updates])
+        changeNotifier.publish(session, 'observations')
+        
+    if obStore is not None and obs: #after the commit- the database is the record if this fails (and the batch must not be retried)
+        try:
+            obStore.append([utc_epoch(cdate) for cdate in dates], masked)
+        except Exception as e:
+            print(f"[colstore] append failed, rebuild with colstore.py: {e}")
+        
+    responseCache.invalidate() #historical pages now include the batch
+    
+obWriter = ObservationWriter(write_observations)
+instrumentation.value('wxserver_writer_pending', obWriter.pending)
+instrumentation.value('wxserver_writer_errors_total', lambda: obWriter.errors, 'counter')
+instrumentation.value('wxserver_writer_dropped_total', lambda: obWriter.failed, 'counter')
+
 
+#obs without repeated dates or dates already in wxobs (e.g. also imported by gendb.py), so rollups count each once
+def unstored_observations(session, obs):
+    if not obs:
+        return obs
+    dates = [cdate for cdate,_ in obs]
+    stored = set(session.execute(select(wxobs.date).where((wxobs.date >= min(dates)) & (wxobs.date <= max(dates)))).scalars())
+    new = {}
+    for cdate, values in obs:
+        if cdate not in stored:
+            new.setdefault(cdate, values)
+    return list(new.items())
+    
+    
+    
+#selects the top bar image for the latest conditions
+def update_header_image(cdate, precip):
+    
+    global locationInfo
+    sun_times = locationInfo.sun_times_for(cdate)
+    if lightning_active(): #lightning alert rule
+        image = "thunderstorm"
+    elif precip >= 1: #rainfall > 1mm/hr recorded
+        image = "rainyday"
+    elif abs((sun_times[1] - cdate).total_seconds()) <= 3600: #within an hour of sunset
+        image = "sunset"
+    elif cdate >= sun_times[0] and cdate <= sun_times[1]: #between sunrise and sunset (daytime)
+        image = "clearday"
+    else: #leaves nighttime, no rain/thunderstorm
+        image = "clearnight"
+        
+    change_image(image)
+    
     
-#change the background panorama, check hash is different to avoid replacing the same file with itself
+#header panorama currently shown, and a content hash of each panorama file used to version its URL
+headerImage = "clearday"
+panoramaVersions = {}
+for panorama in os.listdir(os.path.join(app.static_folder, 'panoramas')):
+    with open(os.path.join(app.static_folder, 'panoramas', panorama), 'rb') as f:
+        panoramaVersions[os.path.splitext(panorama)[0]] = sha1(f.read()).hexdigest()[:12]
+        
+#switches the header panorama (an in-memory change- pages link straight to the selected image)
 def change_image(image):
-    new_header = f"static/panoramas/{image}.jpg"
-    current_header = "static/background/default.jpg"
-    if sha1(new_header.encode('utf-8')).hexdigest() != sha1(current_header.encode('utf-8')).hexdigest():
-        shutil.copy(new_header,current_header)
+    global headerImage
+    if image != headerImage:
+        headerImage = image
+        responseCache.invalidate() #cached pages still link to the old image
+        
+#versioned header image URL for base.html: the URL changes whenever the image (or its content) does,
+#so browsers can cache each panorama indefinitely
+@app.context_processor
+def header_image_context():
+    return {'header_image_url': url_for('static', filename=f'panoramas/{headerImage}.jpg', v=panoramaVersions.get(headerImage))}
+    
+@app.after_request
+def cache_versioned_static(response):
+    if request.path.startswith('/static/panoramas/') and 'v' in request.args and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+    
+#header image for the latest observation
+def refresh_header_image():
+    lastob = latest_observation()
+    if len(lastob) > 0:
+        update_header_image(datetime.utcfromtimestamp(int(lastob.epoch[0])), lastob.precip[0])
+        
+refresh_header_image()
         
 
 #update GPS position
 @app.route('/updateGPS', methods=['POST'])
 def updateGPS():
     
-    global latitude, longitude, locationstr
-    
     if validate_request(request):
             
         try:
             locationInfo.update(request.form['latitude'],request.form['longitude'])
+            with writeSession.begin() as session:
+                store_location(session)
+            responseCache.invalidate()
+            publish_event('location', location_event())
             return "SUCCESS"
         except KeyError:
             return "MISSING_POST_FIELD"
+        except ValueError:
+            return "INVALID_POST_FIELD"
             
     else:
         return "INVALID_CREDENTIAL"
@@ -432,19 +1066,27 @@ def updateGPS():
         
 
 #new lightning strike
-#update GPS position
 @app.route('/strikereport', methods=['POST'])
 def strikereport():
-    global lastStrikeTime, lastStrikeDist
     
     if validate_request(request):
         
         try:
-            lastStrikeTime = parsedatestr(request.form['date'])
-            lastStrikeDist = int(np.round(float(request.form['distance'])))
+            strikedate = parsedatestr(request.form['date'])
+            distance = float(request.form['distance'])
+            if not strikedate:
+                return "INVALID_POST_FIELD"
+                
+            with writeSession.begin() as session:
+                session.add(wxstrikes(date=strikedate, distance=distance))
+                changeNotifier.publish(session, 'strikes')
+            strikes = load_recent_strikes()
+            publish_strikes(strikes)
+            observe_strikes(strikes)
+            responseCache.invalidate()
             
-            #switch top bar image to thunderstorm if strike within 30 km
-            if lastStrikeDist <= 30:
+            #switch top bar image to thunderstorm if the strike set off the lightning alert
+            if lightning_active():
                 change_image("thunderstorm")
             
             #return success message to indicate data was added
@@ -452,9 +1094,63 @@ def strikereport():
             
         except KeyError:
             return "MISSING_POST_FIELD"
+        except ValueError:
+            return "INVALID_POST_FIELD"
             
     else:
         return "INVALID_CREDENTIAL"
+        
+        
+        
+#######################################################################################
+#                                   SHARED STATE                                      #
+#######################################################################################
+
+#changes made by other worker processes, picked up before the next request is handled
+
+
+def observations_changed():
+    global dateBounds
+    newest = recentObs.latest(locationInfo.tzinfo).epoch
+    load_recent_obs()
+    dateBounds = None #reread from wxmeta
+    refresh_header_image()
+    responseCache.invalidate()
+    newobs = recentObs.since(int(newest[0]) + 1 if len(newest) else 0, locationInfo.tzinfo)[::-1]
+    observe_alerts(newobs)
+    if eventListeners:
+        publish_observations(newobs)
+    
+def strikes_changed():
+    strikes = load_recent_strikes()
+    publish_strikes(strikes)
+    observe_strikes(strikes)
+    refresh_header_image()
+    responseCache.invalidate()
+    
+def location_changed():
+    load_location()
+    responseCache.invalidate()
+    publish_event('location', location_event())
+    
+    
+#live events (see asgi.py): observations oldest first, in the /obsdata format
+def publish_observations(newobs):
+    if len(newobs) > 0:
+        publish_event('observation', {"since": int(newobs.epoch.min()), "cursor": int(newobs.epoch.max()), "data": newobs.json_data()})
+        
+def publish_strikes(strikes):
+    for epoch, distance in strikes:
+        publish_event('strike', {"date": epoch, "distance": distance})
+    
+changeNotifier.subscribe('observations', observations_changed)
+changeNotifier.subscribe('strikes', strikes_changed)
+changeNotifier.subscribe('location', location_changed)
+
+
+@app.before_request
+def poll_shared_state():
+    changeNotifier.poll(db.session)
 
 
 #######################################################################################
@@ -502,116 +1198,148 @@ def plot_styler(p):
 
     
     
+#builds the figure layout (axes, glyphs, legend, hover) for one variant, with an empty data source
+#envelopes adds min/max bands for decimated data (see decimate.py)
+def build_observations_figure(is_mobile, envelopes):
+
+    columns = ["date"] + OB_VARS + ([f"{var}_{stat}" for var in ENVELOPE_VARS for stat in ['min','max']] if envelopes else [])
+    source = ColumnDataSource(data={column:[] for column in columns}, name="obs_source") #named so pages can stream to it
+    
+    #initializing figure
+    p = figure(height=400, width=1500, aspect_ratio=3, min_height=300, title='', x_axis_type="datetime", toolbar_location="above",
+        tools="pan,wheel_zoom,box_zoom,reset")
+    p.extra_y_ranges = {}
+    p.yaxis.visible = False #drop default y axis
+    
+    #temperature
+    p.extra_y_ranges["temp"] = Range1d(start=0, end=1, name="range_temp") #set per request
+    p.add_layout(LinearAxis(y_range_name="temp", axis_line_color="red"), 'left')
+    p.line(x="date", y="temp", source=source, line_color="red", name="Temperature", y_range_name="temp", legend_label="Temperature")
+    p.scatter(x="date", y="temp", source=source, color="red", name="Temperature", y_range_name="temp",  legend_label="Temperature")
+    if envelopes:
+        p.varea(x="date", y1="temp_min", y2="temp_max", source=source, fill_color="red", fill_alpha=0.15, name="Temperature", y_range_name="temp", legend_label="Temperature")
+    
+    #humidity
+    p.extra_y_ranges["rh"] = Range1d(start=0, end=1, name="range_rh") #set per request
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="rh", axis_line_color="blue"), 'left')
+    p.line(x="date", y="rh", source=source, line_color="blue", name="Humidity", y_range_name="rh", legend_label="Humidity")
+    p.scatter(x="date", y="rh", source=source, color="blue", name="Humidity", y_range_name="rh", legend_label="Humidity")
+    if envelopes:
+        p.varea(x="date", y1="rh_min", y2="rh_max", source=source, fill_color="blue", fill_alpha=0.15, name="Humidity", y_range_name="rh", legend_label="Humidity")
+    
+    #pressure
+    p.extra_y_ranges["pres"] = Range1d(start=0, end=1, name="range_pres") #set per request
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="pres", axis_line_color="green"), 'left')
+    p.line(x="date", y="pres", source=source, line_color="green", name="Pressure", y_range_name="pres", legend_label="Pressure")
+    p.scatter(x="date", y="pres", source=source, color="green", name="Pressure", y_range_name="pres", legend_label="Pressure")
+    if envelopes:
+        p.varea(x="date", y1="pres_min", y2="pres_max", source=source, fill_color="green", fill_alpha=0.15, name="Pressure", y_range_name="pres", legend_label="Pressure")
+    
+    #wind speed
+    p.extra_y_ranges["wspd"] = Range1d(start=0, end=1, name="range_wspd") #set per request
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="wspd", axis_line_color="orange"), 'left')
+    p.line(x="date", y="wspd", source=source, line_color="orange", name="Wind Speed", y_range_name="wspd", legend_label="Wind Speed")
+    p.scatter(x="date", y="wspd", source=source, color="orange", name="Wind Speed", y_range_name="wspd", legend_label="Wind Speed")
+    
+    #wind gust
+    # p.extra_y_ranges["wgust"] = Range1d(start=0, end=np.ceil(np.max(np.array([np.max(wgust), 10]))+1))
+    # if not is_mobile: #same axis as wind speed
+    # p.add_layout(LinearAxis(y_range_name="wspd", axis_line_color="orange"), 'left')
+    p.line(x="date", y="wgust", source=source, line_color="coral", name="Wind Gust", y_range_name="wspd", legend_label="Wind Gust")
+    p.scatter(x="date", y="wgust", source=source, color="coral", name="Wind Gust", y_range_name="wspd", legend_label="Wind Gust")
+    
+    #wind direction
+    p.extra_y_ranges["wdir"] = Range1d(start=-5, end=365)
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="wdir", axis_line_color="purple"), 'left')
+    p.scatter(x="date", y="wdir", source=source, color="purple", name="Wind Direction", y_range_name="wdir", legend_label="Wind Direction")
+    
+    #precipitation 
+    p.extra_y_ranges["precip"] = Range1d(start=0, end=1, name="range_precip") #set per request
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="precip", axis_line_color="blue"), 'left')
+    p.vbar(x="date",top="precip", width = .9, fill_alpha = .5, fill_color = 'blue', line_alpha = .5, line_color='blue', source=source, name="Precipitation", y_range_name="precip", legend_label="Precipitation")
+    
+    
+    # #solar radiation
+    # p.extra_y_ranges["solar"] = Range1d(start=np.floor(np.min(solar))-1, end=np.ceil(np.max(solar))+1)
+    # p.add_layout(LinearAxis(y_range_name="solar", axis_line_color="yellow"), 'left')
+    # p.line(x="date", y="solar", source=source, line_color="yellow", name="Solar Radiation", y_range_name="solar", legend_label="Solar Radiation")
+    # p.scatter(x="date", y="solar", source=source, color="yellow", name="Solar Radiation", y_range_name="solar", legend_label="Solar Radiation")
+    
+    #lightning strikes
+    p.extra_y_ranges["strikes"] = Range1d(start=0, end=1, name="range_strikes") #set per request
+    if not is_mobile:
+        p.add_layout(LinearAxis(y_range_name="strikes", axis_line_color="yellow"), 'left')
+    p.vbar(x="date",top="strikes", width = .9, fill_alpha = .5, fill_color = 'yellow', line_alpha = .5, line_color='yellow', source=source, name="Lightning Strikes", y_range_name="strikes", legend_label="Lightning Strikes")
+    
+    
+    #adding legend
+    p.legend.location = "top_left"
+    p.legend.click_policy="hide"
+    
+    
+    #adding hover tool
+    TOOLTIPS=[("Date", "@date{%Y-%m-%d %H:%M}"), 
+                ("Temperature (F)", "@temp{00.0}"), 
+                ("Humidity (%)", "@rh{00.0}"), 
+                ("Pressure (mb)", "@pres{0000.0}"),
+                ("Wind Speed (mph)", "@wspd{0.0}"),
+                ("Wind Gust (mph)", "@wgust{0.0}"),
+                ("Wind Direction", "@wdir{000}"),
+                ("Precipitation (mm/hr)", "@precip{0.0}"), #("Solar Radiation", "@solar"),
+                ("Lightning (strikes/hr)", "@strikes{0.0}")] #setting tooltips for interactive hover
+    hovertool = HoverTool(tooltips=TOOLTIPS, formatters={'@date': 'datetime'}) # use 'datetime' formatter for '@date' field
+    p.add_tools(hovertool)
+    
+    plot_styler(p) #applying global stylings for plot
+    
+    return p, source
+    
+    
+    
+#serialized figures keyed by (is_mobile, envelopes): bokeh's model serialization is the expensive part
+#of plotting and doesn't depend on the data, so each variant is built and serialized once and every
+#request only sends its data and axis ranges (applied in the browser by plotdata.html)
+plotTemplates = {}
+plotTemplatesLock = threading.Lock()
+
+@instrumentation.timed('plot')
 def observations_plot(obs, is_mobile):
     
     try:
-        # source = ColumnDataSource(data={"date":date, "temp":temp, "rh":rh, "pres":pres, "wspd":wspd, "wdir":wdir, "precip":precip, "solar":solar, "strikes":strikes}) #organizing data into columndatasource format
-        date = [ob.date for ob in obs]
-        temp = [ob.temp for ob in obs]
-        rh = [ob.rh for ob in obs]
-        pres = [ob.pres for ob in obs]
-        wspd = [ob.wspd for ob in obs]
-        wgust = [ob.wgust for ob in obs]
-        wdir = [ob.wdir for ob in obs]
-        precip = [ob.precip for ob in obs]
-        # solar = []
-        strikes = [ob.strikes for ob in obs]
-        source = ColumnDataSource(data={"date":date, "temp":temp, "rh":rh, "pres":pres, "wspd":wspd, "wgust":wgust, "wdir":wdir, "precip":precip, "strikes":strikes}) #organizing data into columndatasource format
-        
-        #initializing figure
-        p = figure(height=400, width=1500, aspect_ratio=3, min_height=300, title='', x_axis_type="datetime", toolbar_location="above",
-            tools="pan,wheel_zoom,box_zoom,reset")
-        p.extra_y_ranges = {}
-        p.yaxis.visible = False #drop default y axis
-        
-        #temperature
-        p.extra_y_ranges["temp"] = Range1d(start=np.floor(np.min(temp))-1, end=np.ceil(np.max(temp))+1)
-        p.add_layout(LinearAxis(y_range_name="temp", axis_line_color="red"), 'left')
-        p.line(x="date", y="temp", source=source, line_color="red", name="Temperature", y_range_name="temp", legend_label="Temperature")
-        p.scatter(x="date", y="temp", source=source, color="red", name="Temperature", y_range_name="temp",  legend_label="Temperature")
-        
-        #humidity
-        p.extra_y_ranges["rh"] = Range1d(start=np.floor(np.min(rh))-1, end=np.ceil(np.max(rh))+1)
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="rh", axis_line_color="blue"), 'left')
-        p.line(x="date", y="rh", source=source, line_color="blue", name="Humidity", y_range_name="rh", legend_label="Humidity")
-        p.scatter(x="date", y="rh", source=source, color="blue", name="Humidity", y_range_name="rh", legend_label="Humidity")
-        
-        #pressure
-        p.extra_y_ranges["pres"] = Range1d(start=np.floor(np.min(pres))-1, end=np.ceil(np.max(pres))+1)
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="pres", axis_line_color="green"), 'left')
-        p.line(x="date", y="pres", source=source, line_color="green", name="Pressure", y_range_name="pres", legend_label="Pressure")
-        p.scatter(x="date", y="pres", source=source, color="green", name="Pressure", y_range_name="pres", legend_label="Pressure")
-        
-        #wind speed
-        p.extra_y_ranges["wspd"] = Range1d(start=0, end=np.ceil(np.max(np.array([np.max(wgust), 10]))+1))
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="wspd", axis_line_color="orange"), 'left')
-        p.line(x="date", y="wspd", source=source, line_color="orange", name="Wind Speed", y_range_name="wspd", legend_label="Wind Speed")
-        p.scatter(x="date", y="wspd", source=source, color="orange", name="Wind Speed", y_range_name="wspd", legend_label="Wind Speed")
-        
-        #wind gust
-        # p.extra_y_ranges["wgust"] = Range1d(start=0, end=np.ceil(np.max(np.array([np.max(wgust), 10]))+1))
-        # if not is_mobile: #same axis as wind speed
-        # p.add_layout(LinearAxis(y_range_name="wspd", axis_line_color="orange"), 'left')
-        p.line(x="date", y="wgust", source=source, line_color="coral", name="Wind Gust", y_range_name="wspd", legend_label="Wind Gust")
-        p.scatter(x="date", y="wgust", source=source, color="coral", name="Wind Gust", y_range_name="wspd", legend_label="Wind Gust")
-        
-        #wind direction
-        p.extra_y_ranges["wdir"] = Range1d(start=-5, end=365)
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="wdir", axis_line_color="purple"), 'left')
-        p.scatter(x="date", y="wdir", source=source, color="purple", name="Wind Direction", y_range_name="wdir", legend_label="Wind Direction")
-        
-        #precipitation 
-        p.extra_y_ranges["precip"] = Range1d(start=np.floor(np.min(precip)), end=np.ceil(np.max(precip))+1)
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="precip", axis_line_color="blue"), 'left')
-        p.vbar(x="date",top="precip", width = .9, fill_alpha = .5, fill_color = 'blue', line_alpha = .5, line_color='blue', source=source, name="Precipitation", y_range_name="precip", legend_label="Precipitation")
-        
-        
-        # #solar radiation
-        # p.extra_y_ranges["solar"] = Range1d(start=np.floor(np.min(solar))-1, end=np.ceil(np.max(solar))+1)
-        # p.add_layout(LinearAxis(y_range_name="solar", axis_line_color="yellow"), 'left')
-        # p.line(x="date", y="solar", source=source, line_color="yellow", name="Solar Radiation", y_range_name="solar", legend_label="Solar Radiation")
-        # p.scatter(x="date", y="solar", source=source, color="yellow", name="Solar Radiation", y_range_name="solar", legend_label="Solar Radiation")
-        
-        #lightning strikes
-        p.extra_y_ranges["strikes"] = Range1d(start=np.floor(np.min(strikes)), end=np.ceil(np.max(strikes))+1)
-        if not is_mobile:
-            p.add_layout(LinearAxis(y_range_name="strikes", axis_line_color="yellow"), 'left')
-        p.vbar(x="date",top="strikes", width = .9, fill_alpha = .5, fill_color = 'yellow', line_alpha = .5, line_color='yellow', source=source, name="Lightning Strikes", y_range_name="strikes", legend_label="Lightning Strikes")
-        
-        
-        #adding legend
-        p.legend.location = "top_left"
-        p.legend.click_policy="hide"
-        
-        
-        #adding hover tool
-        TOOLTIPS=[("Date", "@date{%Y-%m-%d %H:%M}"), 
-                    ("Temperature (F)", "@temp{00.0}"), 
-                    ("Humidity (%)", "@rh{00.0}"), 
-                    ("Pressure (mb)", "@pres{0000.0}"),
-                    ("Wind Speed (mph)", "@wspd{0.0}"),
-                    ("Wind Gust (mph)", "@wgust{0.0}"),
-                    ("Wind Direction", "@wdir{000}"),
-                    ("Precipitation (mm/hr)", "@precip{0.0}"), #("Solar Radiation", "@solar"),
-                    ("Lightning (strikes/hr)", "@strikes{0.0}")] #setting tooltips for interactive hover
-        hovertool = HoverTool(tooltips=TOOLTIPS, formatters={'@date': 'datetime'}) # use 'datetime' formatter for '@date' field
-        p.add_tools(hovertool)
-        
-        plot_styler(p) #applying global stylings for plot
-        
-        script,div = components(p) #pulling javascript/html components to embed in webpage
-                
-        return script + div
-    
+        temp, rh, pres, wgust, precip, strikes = obs.temp, obs.rh, obs.pres, obs.wgust, obs.precip, obs.strikes
+        if obs.extremes: #decimated data- axis ranges must include the peaks inside each bucket
+            temp, rh, pres = [np.append(obs.extremes[var + '_min'], obs.extremes[var + '_max']) for var in ['temp','rh','pres']]
+            
+        #ranges skip values masked by quality control (NaN), falling back to 0-1 if a variable has none
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) #all-NaN slices
+            ranges = {"temp": (np.floor(np.nanmin(temp))-1, np.ceil(np.nanmax(temp))+1),
+                      "rh": (np.floor(np.nanmin(rh))-1, np.ceil(np.nanmax(rh))+1),
+                      "pres": (np.floor(np.nanmin(pres))-1, np.ceil(np.nanmax(pres))+1),
+                      "wspd": (0, np.ceil(np.nanmax(np.append(wgust, 10)))+1),
+                      "precip": (np.floor(np.nanmin(precip)), np.ceil(np.nanmax(precip))+1),
+                      "strikes": (np.floor(np.nanmin(strikes)), np.ceil(np.nanmax(strikes))+1)}
+        ranges = {name:(start, end) if np.isfinite(start) and np.isfinite(end) else (0, 1) for name,(start, end) in ranges.items()}
+        
     except ValueError:
         
         return "No data available within the specified time period!"
         
+    key = (is_mobile, bool(obs.extremes))
+    with plotTemplatesLock:
+        if key not in plotTemplates:
+            p, source = build_observations_figure(*key)
+            script,div = components(p) #pulling javascript/html components to embed in webpage
+            plotTemplates[key] = script + div
+            
+    payload = {"data": obs.json_data(), "ranges": {name:[float(start), float(end)] for name,(start,end) in ranges.items()}}
+    return plotTemplates[key] + render_template('plotdata.html', payload=payload)
+        
     
 
     
@@ -627,18 +1355,9 @@ def observations_plot(obs, is_mobile):
 #######################################################################################
 
 
-#time zone configuration
-def replacetimezone(inputdate,inputzone,outputzone):
-    
-    inputdate = inputdate.replace(tzinfo=inputzone)
-    outputdate = inputdate.astimezone(outputzone)
-    
-    return outputdate
-    
-    
-    
 def parsedatestr(datestr):
     if datestr:
+        date = False #unrecognized length
         try:
             if len(datestr) == 4:
                 date = datetime.strptime(datestr,'%Y')
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+#ASGI entry point: serves the live event stream at /events and everything else through the Flask app
+#run with an ASGI server, e.g. uvicorn asgi:application --workers 4
+#
+#/events is a Server-Sent Events stream (use EventSource in a browser) of:
+#   observation: {"since": oldest epoch, "cursor": newest epoch, "data": same columns as /obsdata}
+#   strike: {"date": epoch, "distance": km}
+#   location: {"latitude", "longitude", "locationstr"}
+#   alert: {"name", "message", "value", "since"} when an alert rule (see alerts.py) becomes active
+#events from uploads handled by this process are pushed immediately, changes made by other worker
+#processes arrive through the shared state polling (within changeNotifier.poll_interval)
+
+import asyncio
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, db, changeNotifier, eventListeners
+from eventbroker import EventBroker
+
+
+
+#######################################################################################
+#                                   EVENT STREAM                                      #
+#######################################################################################
+
+keepalive_seconds = 15 #comment lines sent to idle streams so proxies don't close them
+
+broker = EventBroker()
+eventListeners.append(broker.publish_threadsafe)
+flaskApp = WsgiToAsgi(app)
+
+
+def poll_shared_state():
+    with app.app_context():
+        changeNotifier.poll(db.session)
+
+
+async def poll_forever():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(changeNotifier.poll_interval)
+        try:
+            await loop.run_in_executor(None, poll_shared_state)
+        except Exception as e: #keep polling through e.g. a locked database
+            print(f"[asgi] shared state poll failed: {e}")
+
+
+async def startup():
+    if broker.loop is None:
+        broker.start()
+        asyncio.get_running_loop().create_task(poll_forever())
+
+
+#returns once the client has gone (the request body messages of the GET come first)
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+
+async def stream_events(scope, receive, send):
+
+    headers = dict(scope['headers'])
+    try:
+        last_id = int(headers[b'last-event-id'])
+    except (KeyError, ValueError):
+        last_id = None
+
+    queue = broker.subscribe(last_id)
+    if queue is None:
+        await send({'type': 'http.response.start', 'status': 503, 'headers': [(b'retry-after', b'30')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                                                              (b'x-accel-buffering', b'no')]}) #no proxy buffering
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        while True:
+            message = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({message, disconnected}, timeout=keepalive_seconds, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                message.cancel()
+                break
+            if message not in done:
+                message.cancel()
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+            if message.result() is None: #fell behind- client reconnects with Last-Event-ID
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            await send({'type': 'http.response.body', 'body': message.result(), 'more_body': True})
+        disconnected.cancel()
+
+    finally:
+        broker.unsubscribe(queue)
+
+
+
+async def application(scope, receive, send):
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    await startup() #servers without lifespan support
+
+    if scope['type'] == 'http' and scope['path'] == '/events':
+        await stream_events(scope, receive, send)
+    else:
+        await flaskApp(scope, receive, send)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+#benchmarks the server against synthetic datasets (see synthdata.py) and saves the results as JSON
+#usage, from the repository root: python benchmarks/run.py [--sizes month,year,5year] [--compare old.json]
+# - gendb.py import time, rows/sec and peak RSS for each dataset
+# - latency percentiles of the page/API routes with the response cache cleared (cold) and primed (warm),
+#   and the peak Python memory traced while serving one request
+# - ingestion (/addnewob, /addnewobs) and export (/export) rows/sec
+#each dataset is served by a fresh process, since the app reads its database URI when imported
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+
+from synthdata import SIZES, generate_csvs
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#a route more than this much slower (or less throughput) than in the compared results is reported
+regression_ratio = 1.2
+
+
+
+#######################################################################################
+#                                   MEASUREMENT                                       #
+#######################################################################################
+
+
+def percentiles(seconds):
+    ms = 1000*np.asarray(seconds)
+    return {'n': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+#peak RSS of this process in MB (ru_maxrss is KiB on Linux)
+def peak_rss_mb(usage=None):
+    return (usage or resource.getrusage(resource.RUSAGE_SELF)).ru_maxrss/1024
+
+
+def database_env(dbfile):
+    return dict(os.environ, WXSERVER_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.abspath(dbfile))
+
+
+#imports csvdir into a new database with gendb.py (in its own process, so its memory is measured alone)
+def run_gendb(csvdir, dbfile, rows):
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(dbfile + suffix):
+            os.remove(dbfile + suffix)
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'gendb.py', csvdir], cwd=REPO, env=database_env(dbfile), stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"gendb.py failed for {csvdir}")
+    return {'seconds': elapsed, 'rows_per_sec': rows/elapsed, 'peak_rss_mb': peak_rss_mb(usage)}
+
+
+
+#######################################################################################
+#                                   ROUTE BENCHMARKS                                  #
+#######################################################################################
+
+#everything below runs in the process serving one dataset (run.py --routes dbfile)
+
+
+def time_get(client, url, repeats, before=None):
+    times = []
+    for _ in range(repeats):
+        if before:
+            before()
+        start = time.perf_counter()
+        response = client.get(url)
+        times.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+    return times
+
+
+#peak traced Python memory (MB) while serving one request
+def traced_peak_mb(request):
+    tracemalloc.start()
+    try:
+        request()
+        return tracemalloc.get_traced_memory()[1]/1024/1024
+    finally:
+        tracemalloc.stop()
+
+
+#streams a response without holding it in memory, returns the number of bytes
+def consume(response):
+    nbytes = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return nbytes
+
+
+def observation_fields(date, i):
+    return {'date': date.strftime('%Y-%m-%d-%H-%M-%S'), 'ta': 20 + i%10, 'rh': 60, 'pres': 1013, 'wspd': 4, 'wgust': 9,
+            'wdir': i%360, 'precip': 0, 'solar': 300, 'strikes': 0}
+
+
+def bench_routes(dbfile, repeats):
+
+    os.environ.update(database_env(dbfile))
+    sys.path.insert(0, REPO)
+    os.chdir(REPO)
+    import app as wxapp
+
+    wxapp.validate_request = lambda request: True #benchmark uploads don't know the station passphrase
+    client = wxapp.app.test_client()
+    invalidate = wxapp.responseCache.invalidate
+    earliest, latest = wxapp.get_date_bounds()
+    fmt = lambda date: date.strftime('%Y%m%d%H%M%S')
+    daterange = lambda days: f"start={fmt(max(earliest, latest - timedelta(days=days)))}&end={fmt(latest)}"
+
+    routes = {'current': '/',
+              'currentdata': '/currentdata',
+              'obsdata': f"/obsdata?since={wxapp.utc_epoch(latest - timedelta(hours=1))}",
+              'historical_day': f"/historical?{daterange(1)}",
+              'historical_2weeks': f"/historical?{daterange(14)}",
+              'historical_year': f"/historical?{daterange(365)}",
+              'historical_all': f"/historical?start={fmt(earliest)}&end={fmt(latest)}",
+              'historical_table': f"/historical/table?{daterange(365)}&order=desc"}
+
+    results = {'routes': {}}
+    for name, url in routes.items():
+        client.get(url) #first request builds templates/figures
+        results['routes'][name] = {'cold': percentiles(time_get(client, url, repeats, before=invalidate)),
+                                   'warm': percentiles(time_get(client, url, repeats)),
+                                   'peak_traced_mb': traced_peak_mb(lambda: (invalidate(), client.get(url)))}
+
+    #exports of the whole dataset
+    with wxapp.app.app_context():
+        rows = wxapp.db.session.query(wxapp.wxobs).count()
+    results['export'] = {}
+    for fmtname in wxapp.EXPORTERS:
+        url = f"/export?format={fmtname}&start={fmt(earliest)}&end={fmt(latest + timedelta(seconds=1))}"
+        start = time.perf_counter()
+        nbytes = consume(client.get(url, buffered=False))
+        elapsed = time.perf_counter() - start
+        results['export'][fmtname] = {'seconds': elapsed, 'rows_per_sec': rows/elapsed, 'megabytes': nbytes/1024/1024}
+
+    #ingestion after the data, one observation per request and in bulk (timed until written to the database)
+    nobs = 20*repeats
+    times = []
+    start = time.perf_counter()
+    for i in range(nobs):
+        fields = dict(observation_fields(latest + timedelta(minutes=i + 1), i), credential="")
+        t0 = time.perf_counter()
+        client.post('/addnewob', data=fields)
+        times.append(time.perf_counter() - t0)
+    wxapp.obWriter.flush()
+    results['ingest'] = {'addnewob': dict(percentiles(times), rows_per_sec=nobs/(time.perf_counter() - start))}
+
+    batch = 1000
+    lines = []
+    for i in range(10*batch):
+        fields = observation_fields(latest + timedelta(minutes=nobs + i + 1), i)
+        lines.append(",".join(str(fields[field]) for field in wxapp.CSV_FIELDS))
+    start = time.perf_counter()
+    for i in range(0, len(lines), batch):
+        client.post('/addnewobs', data={'credential': "", 'data': "\n".join(lines[i:i+batch])})
+    wxapp.obWriter.flush()
+    results['ingest']['addnewobs'] = {'batch': batch, 'rows_per_sec': len(lines)/(time.perf_counter() - start)}
+
+    results['rows'] = rows
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+
+#######################################################################################
+#                                   RESULTS                                           #
+#######################################################################################
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+#(path, value, higher_is_better) for every compared metric
+def metrics(results, path=()):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from metrics(value, path + (key,))
+        elif key == 'p50_ms':
+            yield "/".join(path + (key,)), value, False
+        elif key == 'rows_per_sec':
+            yield "/".join(path + (key,)), value, True
+
+
+#prints every metric that got worse by more than regression_ratio, returns the number of regressions
+def compare(old, new):
+    oldmetrics = {path: value for path, value, _ in metrics(old['datasets'])}
+    regressions = 0
+    for path, value, higher_is_better in metrics(new['datasets']):
+        if path not in oldmetrics or not value or not oldmetrics[path]:
+            continue
+        ratio = oldmetrics[path]/value if higher_is_better else value/oldmetrics[path]
+        if ratio > regression_ratio:
+            regressions += 1
+            print(f"REGRESSION {path}: {oldmetrics[path]:.3f} -> {value:.3f} ({ratio:.2f}x worse)")
+    print(f"{regressions} regressions vs {old.get('commit')}")
+    return regressions
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks routes, ingestion and export on synthetic station data")
+    parser.add_argument("--sizes", default=",".join(SIZES), help=f"comma-separated datasets from {', '.join(SIZES)}")
+    parser.add_argument("--workdir", default=os.path.join(REPO, "benchmarks", "data"), help="where CSVs and databases are kept")
+    parser.add_argument("--repeats", type=int, default=20, help="timed requests per route")
+    parser.add_argument("--output", help="results file (default benchmarks/results-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to check for regressions")
+    parser.add_argument("--routes", help=argparse.SUPPRESS) #internal: benchmark routes on this database and print JSON
+    args = parser.parse_args()
+
+    if args.routes:
+        print(json.dumps(bench_routes(args.routes, args.repeats)))
+        sys.exit(0)
+
+    commit = git_commit()
+    results = {'commit': commit, 'date': datetime.utcnow().isoformat(), 'python': platform.python_version(),
+               'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeats': args.repeats, 'datasets': {}}
+
+    for size in args.sizes.split(","):
+        days = SIZES[size]
+        csvdir = os.path.join(args.workdir, size, "csv")
+        dbfile = os.path.join(args.workdir, size, "wxobs.db")
+        lastfile = f"WxO_{(datetime.utcnow() - timedelta(days=1)).strftime('%Y%m%d')}.csv"
+        if not os.path.exists(os.path.join(csvdir, lastfile)): #data always ends at midnight UTC, so the /current page has data
+            print(f"[{size}] generating {days} days of CSVs")
+            shutil.rmtree(csvdir, ignore_errors=True)
+            generate_csvs(csvdir, days)
+
+        print(f"[{size}] importing with gendb.py")
+        dataset = {'days': days, 'gendb': run_gendb(csvdir, dbfile, days*1440)}
+
+        print(f"[{size}] benchmarking routes")
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--routes', dbfile, '--repeats', str(args.repeats)],
+                                cwd=REPO, capture_output=True, text=True)
+        if output.returncode != 0:
+            sys.exit(f"[{size}] route benchmark failed:\n{output.stderr}")
+        dataset.update(json.loads(output.stdout.strip().splitlines()[-1]))
+        results['datasets'][size] = dataset
+
+        for name, route in dataset['routes'].items():
+            print(f"[{size}] {name}: cold p50 {route['cold']['p50_ms']:.1f} ms, warm p50 {route['warm']['p50_ms']:.2f} ms")
+
+    output = args.output or os.path.join(REPO, "benchmarks", f"results-{commit or 'local'}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(json.load(f), results) else 0)
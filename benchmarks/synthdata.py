@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+#synthetic one-minute station data in the 10-column WxO CSV format read by gendb.py:
+#date (YYYYmmddHHMMSS), temp (C), rh (%), pres (mb), wspd, wgust (mph), wdir (deg), solar, precip (mm/hr), strikes
+#usage: python benchmarks/synthdata.py csvdir days [--end YYYYmmdd]
+
+import argparse
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+
+#dataset sizes used by the benchmarks (days of one-minute data)
+SIZES = {'month': 30, 'year': 365, '5year': 1826}
+
+
+#the 1440 observations of the day starting at date, as a (1440, 10) array (same generator state = same data)
+def synthetic_day(date, rng):
+
+    minutes = np.arange(1440)
+    epoch = (np.datetime64(date.strftime('%Y-%m-%d'), 's') + minutes*60).astype(np.int64)
+    dayofyear = date.timetuple().tm_yday
+    hour = minutes/60
+
+    #seasonal + diurnal cycles with noise
+    season = -np.cos(2*np.pi*(dayofyear - 15)/365)
+    temp = 20 + 8*season + 5*np.sin(2*np.pi*(hour - 9)/24) + np.cumsum(rng.normal(0, 0.05, 1440))
+    rh = np.clip(70 - 2.5*(temp - 20) + rng.normal(0, 2, 1440), 5, 100)
+    pres = 1013 + 6*np.sin(2*np.pi*(epoch/86400)/5) + rng.normal(0, 0.2, 1440)
+    wspd = np.abs(5 + 3*np.sin(2*np.pi*(hour - 14)/24) + rng.normal(0, 1.5, 1440))
+    wgust = wspd + np.abs(rng.normal(0, 3, 1440))
+    wdir = (180 + np.cumsum(rng.normal(0, 3, 1440))) % 360
+    solar = np.clip(1000*np.sin(np.pi*(hour - 6)/12), 0, None)*rng.uniform(0.6, 1, 1440)
+
+    #an afternoon storm on roughly one day in five
+    precip = np.zeros(1440)
+    strikes = np.zeros(1440)
+    if rng.random() < 0.2:
+        start, length = rng.integers(780, 1080), rng.integers(30, 180) #starting 1-6 pm, lasting 0.5-3 hours
+        precip[start:start+length] = rng.gamma(2, 5, length)
+        strikes[start:start+length] = rng.poisson(20, length)
+
+    dates = np.datetime_as_string(epoch.astype('datetime64[s]'))
+    datenums = np.char.replace(np.char.replace(np.char.replace(dates, '-', ''), 'T', ''), ':', '').astype(np.int64)
+    return np.column_stack((datenums, temp, rh, pres, wspd, wgust, wdir, solar, precip, strikes))
+
+
+
+#writes days daily WxO_YYYYmmdd.csv files ending yesterday (or before end), returns the number of rows
+def generate_csvs(csvdir, days, end=None, seed=0):
+    os.makedirs(csvdir, exist_ok=True)
+    end = end or datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    rng = np.random.default_rng(seed)
+    for day in range(days, 0, -1):
+        date = end - timedelta(days=day)
+        data = synthetic_day(date, rng)
+        np.savetxt(os.path.join(csvdir, f"WxO_{date.strftime('%Y%m%d')}.csv"), data, delimiter=',',
+                   fmt=['%d'] + ['%.2f']*9)
+    return days*1440
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Writes synthetic WxO CSV files")
+    parser.add_argument("csvdir")
+    parser.add_argument("days", type=int)
+    parser.add_argument("--end", help="YYYYmmdd, first day not generated (default today UTC)")
+    args = parser.parse_args()
+
+    end = datetime.strptime(args.end, '%Y%m%d') if args.end else None
+    print(f"Wrote {generate_csvs(args.csvdir, args.days, end)} observations to {args.csvdir}")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+#optional observation backend for range reads (app.config OBS_BACKEND = "colstore", e.g. WXSERVER_OBS_BACKEND=colstore)
+#wxobs.db stays the database of record: the store is filled from it once (with the server stopped) with
+#   python colstore.py [directory]
+#and afterwards appended to by the observation writer and gendb.py
+
+import fcntl
+import os
+import sys
+import threading
+import numpy as np
+
+from observations import ObservationArrays, OB_VARS
+
+
+
+#######################################################################################
+#                                  COLUMN STORE                                       #
+#######################################################################################
+
+
+#observations as fixed-width column files: epoch.i8 (int64 UTC seconds, sorted) and one <var>.f4 per variable
+#(float32, raw wxobs units, NaN where quality control flagged the value when it was stored- flags added later by
+#rechecks only reach the store when it is converted again). Files are memory-mapped read-only, so a time range is two binary searches on the
+#epoch column and every column slice is a view of the mapped file. Files only ever grow: appends go on the
+#end, and a batch older than the newest stored observation rewrites the tail in place (never truncating,
+#so mappings held by other requests/processes stay valid). Appends from several processes take a file lock.
+class ColumnStore():
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.files = {'epoch': (os.path.join(directory, 'epoch.i8'), np.dtype(np.int64))}
+        self.files.update({var:(os.path.join(directory, f'{var}.f4'), np.dtype(np.float32)) for var in OB_VARS})
+        for filename, _ in self.files.values():
+            open(filename, 'ab').close()
+        self.length = None
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+
+    #rows completely written to every file (another process may be part way through an append)
+    def stored_length(self):
+        return min(os.path.getsize(filename)//dtype.itemsize for filename, dtype in self.files.values())
+
+
+    #maps the files again if they have grown since they were last mapped (caller holds self.lock)
+    def remap(self):
+        n = self.stored_length()
+        if n != self.length:
+            self.arrays = {name:np.memmap(filename, dtype=dtype, mode='r', shape=(n,)) if n > 0 else np.zeros(0, dtype=dtype)
+                           for name,(filename, dtype) in self.files.items()}
+            self.length = n
+        return self.arrays
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.remap()['epoch'])
+
+
+    #epoch and raw column views of the observations in [start, end] (epoch seconds, None = unbounded)
+    def range(self, start=None, end=None):
+        with self.lock:
+            arrays = self.remap()
+        epoch = arrays['epoch']
+        i = 0 if start is None else np.searchsorted(epoch, start, side='left')
+        j = len(epoch) if end is None else np.searchsorted(epoch, end, side='right')
+        return epoch[i:j], {var:arrays[var][i:j] for var in OB_VARS}
+
+
+    #ObservationArrays of observations in [start, end], oldest first unless descending, at most limit
+    def observations(self, start, end, tzinfo, descending=False, limit=None):
+        epoch, columns = self.range(start, end)
+        order = slice(None, None, -1) if descending else slice(None)
+        epoch = epoch[order][:limit]
+        columns = {var:values[order][:limit] for var,values in columns.items()}
+        columns['temp'] = columns['temp']*np.float32(9/5) + np.float32(32) #convert to F
+        return ObservationArrays(epoch, columns, tzinfo)
+
+
+    #adds observations (epoch seconds and raw values per variable, any order)
+    def append(self, epoch, columns):
+        epoch = np.asarray(epoch, dtype=np.int64)
+        order = np.argsort(epoch, kind='stable')
+        new = {'epoch': epoch[order]}
+        new.update({var:np.asarray(columns[var], dtype=np.float32)[order] for var in OB_VARS})
+        if len(epoch) == 0:
+            return
+
+        with self.lock, open(os.path.join(self.directory, 'append.lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            arrays = self.remap()
+            n = len(arrays['epoch'])
+            position = np.searchsorted(arrays['epoch'], new['epoch'][0], side='right') #rows after this are rewritten
+
+            if position < n: #backfilled observations- merge them into the stored tail
+                merged = np.concatenate((arrays['epoch'][position:], new['epoch']))
+                order = np.argsort(merged, kind='stable')
+                new = {name:np.concatenate((arrays[name][position:], new[name]))[order] for name in self.files}
+
+            for name,(filename, dtype) in self.files.items():
+                with open(filename, 'r+b') as f:
+                    f.seek(position*dtype.itemsize)
+                    f.write(new[name].astype(dtype).tobytes())
+            self.remap()
+
+
+    #empties the store (only while nothing is reading it, e.g. gendb.py --rebuild)
+    def clear(self):
+        with self.lock:
+            for filename, _ in self.files.values():
+                open(filename, 'wb').close()
+            self.length = None
+            self.remap()
+
+
+
+#copies every wxobs observation into a new column store in directory
+def convert(directory, batches):
+    store = ColumnStore(directory)
+    store.clear()
+    for epoch, columns in batches:
+        store.append(epoch, columns)
+    return store
+
+
+
+if __name__ == "__main__":
+
+    from app import app, export_batches, get_date_bounds
+    from datetime import timedelta
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else app.config['COLSTORE_PATH']
+    earliest, latest = get_date_bounds()
+    store = convert(directory, export_batches(earliest, latest + timedelta(seconds=1)))
+    print(f"Wrote {len(store)} observations to {directory}")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+from sqlalchemy import create_engine, event
+
+
+
+#######################################################################################
+#                                SQLITE CONFIGURATION                                 #
+#######################################################################################
+
+#in WAL mode readers and the writer don't block each other (only writers wait for each other), so page loads
+#never stall ingestion. Requests read through Flask-SQLAlchemy's pooled engine; writes go through a separate
+#engine with a single connection whose transactions take the write lock up front (BEGIN IMMEDIATE), so
+#writers queue on busy_timeout instead of failing when a read transaction tries to upgrade to a write.
+
+
+#defaults for the app.config keys read here (set them before configure_database() to override)
+DEFAULT_CONFIG = {'WXDB_JOURNAL_MODE': 'WAL',
+                  'WXDB_SYNCHRONOUS': 'NORMAL', #with WAL, commits are durable across crashes of the server (not of the OS)
+                  'WXDB_CACHE_SIZE': -64000, #page cache per connection, negative = KiB
+                  'WXDB_MMAP_SIZE': 256*1024*1024, #bytes of the file read through a memory map instead of read()
+                  'WXDB_BUSY_TIMEOUT': 10000, #ms a connection waits for another process' write lock
+                  'WXDB_READ_POOL_SIZE': 8, #pooled read connections (plus as many again under load)
+                  }
+
+#PRAGMA set on every new connection, from config key
+PRAGMAS = {'journal_mode': 'WXDB_JOURNAL_MODE',
+           'synchronous': 'WXDB_SYNCHRONOUS',
+           'cache_size': 'WXDB_CACHE_SIZE',
+           'mmap_size': 'WXDB_MMAP_SIZE',
+           'busy_timeout': 'WXDB_BUSY_TIMEOUT',
+           'temp_store': None} #MEMORY
+
+
+#fills in missing config and the read pool options (call before SQLAlchemy(app))
+def configure_database(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('pool_size', app.config['WXDB_READ_POOL_SIZE'])
+    options.setdefault('max_overflow', app.config['WXDB_READ_POOL_SIZE'])
+
+
+#applies the PRAGMAs to every connection engine opens
+def tune_engine(engine, config, immediate=False):
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, key in PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {config[key] if key else 'MEMORY'}")
+        cursor.close()
+        if immediate: #transactions are started by the begin listener below instead of the sqlite3 module
+            dbapi_connection.isolation_level = None
+
+    if immediate:
+        @event.listens_for(engine, "begin")
+        def begin_immediate(connection):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+#engine for writes: one connection, so writes from this process are serialized in the pool
+def create_writer_engine(url, config):
+    return tune_engine(create_engine(url, pool_size=1, max_overflow=0, pool_timeout=config['WXDB_BUSY_TIMEOUT']/1000), config, immediate=True)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from observations import ObservationArrays, OB_VARS
+
+
+
+#######################################################################################
+#                                   DECIMATION                                        #
+#######################################################################################
+
+
+#how each variable is combined when several observations fall into one bucket
+#(precip and strikes are rates- mm/hr and strikes/hr- so they are averaged like the rest, not summed)
+AGGREGATIONS = {'temp':'mean', 'rh':'mean', 'pres':'mean', 'wspd':'mean', 'wgust':'max', 'wdir':'vecmean', 'precip':'mean', 'solar':'mean', 'strikes':'mean'}
+
+#variables that also keep their per-bucket min/max so peaks survive averaging
+ENVELOPE_VARS = ['temp', 'rh', 'pres']
+
+#maximum number of plotted points for desktop/mobile browsers, and finest bucket width (seconds)
+max_points_desktop = 1500
+max_points_mobile = 500
+min_bucket_seconds = 60
+
+
+#number of points to send for a date range, given the user's device
+def target_points(startdate, enddate, is_mobile):
+    max_points = max_points_mobile if is_mobile else max_points_desktop
+    span_points = int((enddate - startdate).total_seconds() // min_bucket_seconds) + 1
+    return max(1, min(max_points, span_points))
+
+
+
+#reduces obs to at most target time buckets, aggregating each variable per AGGREGATIONS
+#returned observations carry <var>_min/<var>_max envelopes for ENVELOPE_VARS in .extremes
+def decimate(obs, target):
+
+    n = len(obs)
+    if n <= target:
+        return obs
+
+    #bucketing needs ascending times, routes may request newest first
+    descending = obs.epoch[0] > obs.epoch[-1]
+    order = np.argsort(obs.epoch, kind='stable')
+    epoch = obs.epoch[order]
+
+    #equal-width time buckets, keeping only those that contain observations
+    span = int(epoch[-1] - epoch[0]) + 1
+    bucket = (epoch - epoch[0]) * target // span
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    counts = np.diff(np.append(starts, n))
+
+    bucket_epoch = np.add.reduceat(epoch, starts) // counts
+    columns = {}
+    extremes = {}
+    for var in OB_VARS:
+        values = getattr(obs, var)[order]
+        method = AGGREGATIONS[var]
+
+        #values masked by quality control (NaN) are left out, and buckets without any valid value stay NaN
+        valid = ~np.isnan(values)
+        validcounts = np.add.reduceat(valid, starts)
+        values0 = np.where(valid, values, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if method == 'mean':
+                columns[var] = np.add.reduceat(values0, starts) / validcounts
+            elif method == 'max':
+                columns[var] = np.fmax.reduceat(values, starts)
+            elif method == 'vecmean': #averages unit vectors so 350 and 10 degrees give 0, not 180
+                rad = np.deg2rad(values0)
+                direction = np.rad2deg(np.arctan2(np.add.reduceat(np.where(valid, np.sin(rad), 0), starts), np.add.reduceat(np.where(valid, np.cos(rad), 0), starts))) % 360
+                columns[var] = np.where(validcounts > 0, direction, np.nan)
+
+        if var in ENVELOPE_VARS: #inputs that are already aggregated (rollups) bring their own envelopes
+            extremes[var + '_min'] = np.fmin.reduceat(obs.extremes.get(var + '_min', getattr(obs, var))[order], starts)
+            extremes[var + '_max'] = np.fmax.reduceat(obs.extremes.get(var + '_max', getattr(obs, var))[order], starts)
+
+    if descending:
+        bucket_epoch = bucket_epoch[::-1]
+        columns = {var:values[::-1] for var,values in columns.items()}
+        extremes = {key:values[::-1] for key,values in extremes.items()}
+
+    decimated = ObservationArrays(bucket_epoch, columns, obs.tzinfo)
+    decimated.extremes = extremes
+    return decimated
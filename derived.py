@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+
+#######################################################################################
+#                               DERIVED METEOROLOGY                                   #
+#######################################################################################
+
+#quantities derived from the measured variables, computed over whole arrays when observations arrive
+#(/addnewob, gendb.py, migratedb.py --derived) and stored beside them in wxobs
+#units follow wxobs: temperatures in C, pressures in mb, rain totals in mm
+
+
+DERIVED_VARS = ['dewpoint', 'heat_index', 'wind_chill', 'feels_like', 'pres_msl', 'pres_tendency', 'rain_1h', 'rain_24h']
+
+#derived variables that are temperatures (shown in F like temp)
+DERIVED_TEMPS = ['dewpoint', 'heat_index', 'wind_chill', 'feels_like']
+
+#seconds of earlier observations needed to derive new ones (the longest rolling window)
+history_seconds = 86400
+
+#pressure tendency is the change over tendency_seconds, if an observation exists within tendency_tolerance of then
+tendency_seconds = 3*3600
+tendency_tolerance = 900
+
+#longest interval (seconds) a rain rate is assumed to cover, so outages don't turn one reading into hours of rain
+max_rain_interval = 600
+
+
+
+def c_to_f(temp):
+    return temp*9/5 + 32
+
+def f_to_c(temp):
+    return (temp - 32)*5/9
+
+
+#Magnus formula (C, %)
+def dewpoint(temp, rh):
+    gamma = np.log(np.clip(rh, 0.1, 100)/100) + 17.625*temp/(243.04 + temp)
+    return 243.04*gamma/(17.625 - gamma)
+
+
+#NWS heat index (F, %): Steadman's simple formula, or the Rothfusz regression with its adjustments when that is >= 80 F
+def heat_index(tempf, rh):
+    simple = 0.5*(tempf + 61 + (tempf - 68)*1.2 + rh*0.094)
+    full = (-42.379 + 2.04901523*tempf + 10.14333127*rh - 0.22475541*tempf*rh - 0.00683783*tempf**2 - 0.05481717*rh**2
+            + 0.00122874*tempf**2*rh + 0.00085282*tempf*rh**2 - 0.00000199*tempf**2*rh**2)
+    dry = (rh < 13) & (tempf >= 80) & (tempf <= 112)
+    full = np.where(dry, full - (13 - rh)/4*np.sqrt(np.clip(17 - np.abs(tempf - 95), 0, None)/17), full)
+    humid = (rh > 85) & (tempf >= 80) & (tempf <= 87)
+    full = np.where(humid, full + (rh - 85)/10*(87 - tempf)/5, full)
+    return np.where((simple + tempf)/2 >= 80, full, simple)
+
+
+#NWS wind chill (F, mph), defined for temperatures <= 50 F and wind >= 3 mph (the temperature otherwise)
+def wind_chill(tempf, wspd):
+    v = np.clip(wspd, 0, None)**0.16
+    chill = 35.74 + 0.6215*tempf - 35.75*v + 0.4275*tempf*v
+    return np.where((tempf <= 50) & (wspd >= 3), chill, tempf)
+
+
+#apparent temperature (F): heat index when hot, wind chill when cold and windy, else the temperature
+def feels_like(tempf, rh, wspd):
+    return np.select([tempf >= 80, (tempf <= 50) & (wspd >= 3)], [heat_index(tempf, rh), wind_chill(tempf, wspd)], tempf)
+
+
+#station pressure (mb) reduced to sea level with the hypsometric equation (temperature in C, elevation in m)
+def sea_level_pressure(pres, temp, elevation):
+    return pres*(1 - 0.0065*elevation/(temp + 0.0065*elevation + 273.15))**-5.257
+
+
+#change in pressure since tendency_seconds before each observation (NaN without an observation near then)
+#epoch must be sorted
+def pressure_tendency(epoch, pres):
+    before = np.searchsorted(epoch, epoch - tendency_seconds, side='right') - 1
+    valid = (before >= 0) & (epoch - tendency_seconds - epoch[np.clip(before, 0, None)] <= tendency_tolerance)
+    return np.where(valid, pres - pres[np.clip(before, 0, None)], np.nan)
+
+
+#rain (mm) in the window seconds up to each observation, from rain rates (mm/hr) that each cover the interval since
+#the previous observation (as the station measures them)
+#epoch must be sorted
+def rolling_rain(epoch, precip, window):
+    interval = np.minimum(np.diff(epoch, prepend=epoch[:1]), max_rain_interval)
+    total = np.cumsum(np.clip(np.nan_to_num(precip), 0, None)*interval/3600) #masked (NaN) rates count as no rain
+    before = np.searchsorted(epoch, epoch - window, side='right') - 1
+    return total - np.where(before >= 0, total[np.clip(before, 0, None)], 0)
+
+
+
+#{var: array} of DERIVED_VARS for observations (epoch seconds, {var: raw array}, any order)
+#history is (epoch, {'pres': array, 'precip': array}) of the history_seconds of observations before them
+def derive(epoch, columns, history=None, elevation=0):
+
+    epoch = np.asarray(epoch, dtype=np.int64)
+    temp, rh, wspd, pres, precip = [np.asarray(columns[var], dtype=np.float64) for var in ['temp', 'rh', 'wspd', 'pres', 'precip']]
+    tempf = c_to_f(temp)
+
+    derived = {'dewpoint': dewpoint(temp, rh),
+               'heat_index': f_to_c(heat_index(tempf, rh)),
+               'wind_chill': f_to_c(wind_chill(tempf, wspd)),
+               'feels_like': f_to_c(feels_like(tempf, rh, wspd)),
+               'pres_msl': sea_level_pressure(pres, temp, elevation)}
+
+    #windowed quantities over the history and the new observations together, in time order
+    if history is not None and len(history[0]) > 0:
+        allepoch = np.concatenate((np.asarray(history[0], dtype=np.int64), epoch))
+        allpres = np.concatenate((np.asarray(history[1]['pres'], dtype=np.float64), pres))
+        allprecip = np.concatenate((np.asarray(history[1]['precip'], dtype=np.float64), precip))
+    else:
+        allepoch, allpres, allprecip = epoch, pres, precip
+    order = np.argsort(allepoch, kind='stable')
+    new = np.argsort(order)[len(allepoch) - len(epoch):] #sorted positions of the new observations
+
+    sortedepoch = allepoch[order]
+    derived['pres_tendency'] = pressure_tendency(sortedepoch, allpres[order])[new]
+    derived['rain_1h'] = rolling_rain(sortedepoch, allprecip[order], 3600)[new]
+    derived['rain_24h'] = rolling_rain(sortedepoch, allprecip[order], 86400)[new]
+    return derived
+
+
+
+#weather condition codes (OpenWeatherMap icon numbers) for observations (temp in F, precip in mm/hr)
+def condition_codes(tempf, rh, precip, wgust, lightning):
+    return np.select([lightning, (precip >= 1) & (tempf > 32), precip >= 1, wgust > 10, (tempf <= 60) & (rh > 85)],
+                     ["11", "10", "13", "04", "50"], "01") #thunderstorm, rain, snow, windy, fog, clear
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import json
+from collections import deque
+
+
+
+#######################################################################################
+#                                   EVENT BROKER                                      #
+#######################################################################################
+
+
+#fans events out to Server-Sent Events subscribers. Each event is serialized once, and each subscriber
+#has a bounded queue: a client that falls queue_size events behind is disconnected (its EventSource
+#reconnects and catches up from history with Last-Event-ID) rather than buffering without limit.
+#Everything runs on one asyncio loop; other threads publish through publish_threadsafe().
+class EventBroker():
+
+    def __init__(self, queue_size=32, history_size=256, max_clients=10000):
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self.history = deque(maxlen=history_size) #(id, message) of recent events, for reconnecting clients
+        self.ids = itertools.count(1)
+        self.subscribers = set()
+        self.loop = None
+        self.dropped = 0 #clients disconnected for falling behind
+
+
+    #binds the broker to the running loop (called from the loop at startup)
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+
+
+    #queue of encoded messages for a new client, starting with any events it missed (None if the broker is full)
+    def subscribe(self, last_id=None):
+        if len(self.subscribers) >= self.max_clients:
+            return None
+        queue = asyncio.Queue(self.queue_size)
+        if last_id is not None:
+            for eventid, message in self.history:
+                if eventid > last_id and not queue.full():
+                    queue.put_nowait(message)
+        self.subscribers.add(queue)
+        return queue
+
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+    def publish(self, event, data):
+        eventid = next(self.ids)
+        message = f"id: {eventid}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+        self.history.append((eventid, message))
+        for queue in list(self.subscribers):
+            if queue.full(): #slow client- empty its queue and tell its stream to close
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+                self.subscribers.discard(queue)
+                self.dropped += 1
+            else:
+                queue.put_nowait(message)
+
+
+    #publish() from any thread (events are dropped until the loop has started)
+    def publish_threadsafe(self, event, data):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.publish, event, data)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+import numpy as np
+import netCDF4
+
+from observations import OB_VARS
+
+try: #parquet export is only offered when pyarrow is installed
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+
+#######################################################################################
+#                                    DATA EXPORT                                      #
+#######################################################################################
+
+#every exporter takes an iterator of (epoch seconds, {var: array}) batches in raw wxobs units
+#and yields the file contents in pieces, so a response can start before the whole range is read
+
+
+#units of each exported variable
+UNITS = {'temp':'degC', 'rh':'percent', 'pres':'mb', 'wspd':'mph', 'wgust':'mph', 'wdir':'degrees', 'precip':'mm/hr', 'solar':'raw', 'strikes':'strikes/hr'}
+
+
+def export_csv(batches):
+    yield "date_utc," + ",".join(OB_VARS) + "\n"
+    for epoch, columns in batches:
+        dates = np.datetime_as_string(epoch.astype('datetime64[s]'))
+        values = [np.char.mod('%g', columns[var]) for var in OB_VARS]
+        yield "".join(",".join(row) + "\n" for row in zip(dates, *values))
+
+
+
+#file-like object that parquet writes into, drained after every row group
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_parquet(batches):
+    schema = pyarrow.schema([('date_utc', pyarrow.timestamp('s'))] + [(var, pyarrow.float64()) for var in OB_VARS])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for epoch, columns in batches: #one row group per batch
+        writer.write_table(pyarrow.table([epoch.astype('datetime64[s]')] + [columns[var] for var in OB_VARS], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+
+#netCDF files can't be written to a stream, so batches are appended to a temporary file that is sent once complete
+def export_netcdf(batches, sendsize=1024*1024):
+    handle, filename = tempfile.mkstemp(suffix=".nc")
+    os.close(handle)
+    try:
+        with netCDF4.Dataset(filename, 'w') as ncfile:
+            ncfile.createDimension('time', None)
+            times = ncfile.createVariable('time', 'i8', ('time',))
+            times.units = "seconds since 1970-01-01 00:00:00"
+            times.calendar = "standard"
+            variables = {}
+            for var in OB_VARS:
+                variables[var] = ncfile.createVariable(var, 'f4', ('time',))
+                variables[var].units = UNITS[var]
+
+            n = 0
+            for epoch, columns in batches:
+                times[n:n+len(epoch)] = epoch
+                for var in OB_VARS:
+                    variables[var][n:n+len(epoch)] = columns[var]
+                n += len(epoch)
+
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(sendsize)
+                if not data:
+                    break
+                yield data
+    finally:
+        os.remove(filename)
+
+
+
+#available formats: (exporter, mimetype)
+EXPORTERS = {'csv': (export_csv, 'text/csv'),
+             'nc': (export_netcdf, 'application/x-netcdf')}
+if pyarrow is not None:
+    EXPORTERS['parquet'] = (export_parquet, 'application/vnd.apache.parquet')
@@ -1,116 +1,210 @@
 from flask_sqlalchemy import SQLAlchemy
-from app import app,db
+from app import app,db,refresh_date_bounds,writeSession,obStore,wxobs
+from observations import OB_VARS, rows_array
+from derived import DERIVED_VARS, derive, history_seconds
+from qc import qc_flags, mask_flagged
+from sqlalchemy import select, func, cast, Integer
+from rollups import rollups_current, rebuild_rollups, update_rollups, rebuild_buckets
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import os
+import sys
 import numpy as np
 import netCDF4
-        
 
+
+#older 9-column files have no gust column and an uncalibrated anemometer: wind speed (and gust) = 3x raw value
+wscale_9col = 3
+
+#rows inserted per executemany call
+chunk_size = 10000
+
+
+#files that have already been loaded, so repeat runs only import new CSVs
+class wximports(db.Model):
+    filename = db.Column(db.String(256), primary_key=True)
+    rows = db.Column(db.Integer, nullable=False)
+    imported = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+
+#reads one WxStation CSV file (9- or 10-column format) into epoch seconds + one array per variable (wxobs units)
 def readfile(filename):
-    
-    dates = []
-    ta = []
-    rh = []
-    pres = []
-    wspd = []
-    wgust = []
-    wdir = []
-    solar = []
-    precip = []
-    strikes = []
-    
-    with open(filename) as f:
-        for line in f:
-            line = line.strip().split(',')
-            
-            if len(line) == 9:
-                addon = 0
-                wscale = 3 #multiply wind speed by 3 for anemometer calibration
-                wgust.append(float(line[4])*wscale)
-            elif len(line) == 10:
-                addon = 1
-                wgust.append(float(line[5]))
-                wscale = 1
-            
-            dates.append(datetime.strptime(f"{line[0]}", "%Y%m%d%H%M%S"))
-            ta.append(float(line[1]))
-            rh.append(float(line[2]))
-            pres.append(float(line[3]))
-            wspd.append(float(line[4])*wscale)
-            wdir.append(float(line[5+addon]))
-            solar.append(float(line[6+addon]))
-            precip.append(float(line[7+addon]))
-            strikes.append(float(line[8+addon]))
-            
-            
-    return dates, ta, rh, pres, wspd, wgust, wdir, solar, precip, strikes
-            
-            
-
-def csv_to_lists(csvdir):
-
-    #getting list of files to read from
-    allfiles = os.listdir(csvdir)
-    allfiles.sort() #numerical (chronological) order
-        
-    #reading in data from CSV files
-    dates = []
-    ta = []
-    rh = []
-    pres = []
-    wspd = []
-    wgust = []
-    wdir = []
-    solar = []
-    precip = []
-    strikes = []
-    
-    for file in allfiles:
-        
-        if file[:3] == "WxO": #only csv files
-            fdates, fta, frh, fpres, fwspd, fwgust, fwdir, fsolar, fprecip, fstrikes = readfile(csvdir + file)
-                
-            for (cdate,cta,crh,cpres,cwspd,cwgust,cwdir,csolar,cprecip,cstrikes) in zip(fdates, fta, frh, fpres, fwspd, fwgust, fwdir, fsolar, fprecip, fstrikes):
-                dates.append(cdate)
-                ta.append(cta)
-                rh.append(crh)
-                pres.append(cpres)
-                wspd.append(cwspd)
-                wgust.append(cwgust)
-                wdir.append(cwdir)
-                solar.append(csolar)
-                precip.append(cprecip)
-                strikes.append(cstrikes)
-                
-    return dates, ta, rh, pres, wspd, wgust, wdir, solar, precip, strikes
-
-    
+
+    try:
+        data = np.loadtxt(filename, delimiter=',', dtype=np.float64, ndmin=2)
+        formats = np.full(len(data), data.shape[1])
+    except ValueError: #file mixes both formats- pad 9-column lines so columns line up
+        lines = [line.strip().split(',') for line in open(filename) if line.strip()]
+        formats = np.array([len(line) for line in lines])
+        data = np.array([line[:5] + [line[4]] + line[5:] if len(line) == 9 else line for line in lines], dtype=np.float64).reshape(-1, 10)
+
+    if data.size == 0: #empty file (loadtxt returns a single empty column)
+        data = np.zeros((0, 10))
+
+    if data.shape[1] == 9: #whole file in the old format- insert gust column (copy of speed)
+        data = np.insert(data, 5, data[:,4], axis=1)
+
+    #calibrating wind speed/gust for 9-column lines
+    scale = np.where(formats == 9, wscale_9col, 1)
+    data[:,4] *= scale
+    data[:,5] *= scale
+
+    #columns: date, ta, rh, pres, wspd, wgust, wdir, solar, precip, strikes
+    columns = {'temp':data[:,1], 'rh':data[:,2], 'pres':data[:,3], 'wspd':data[:,4], 'wgust':data[:,5], 'wdir':data[:,6], 'solar':data[:,7], 'precip':data[:,8], 'strikes':data[:,9]}
+    return parse_dates(data[:,0]), columns
+
+
+
+#YYYYmmddHHMMSS numbers -> epoch seconds, without per-line strptime
+def parse_dates(datenums):
+    d = datenums.astype(np.int64)
+    years = (d//10000000000 - 1970).astype('timedelta64[Y]')
+    months = (d//100000000%100 - 1).astype('timedelta64[M]')
+    dates = (np.datetime64('1970', 'Y') + years + months).astype('datetime64[s]')
+    dates += ((d//1000000%100 - 1)*86400 + d//10000%100*3600 + d//100%100*60 + d%100).astype('timedelta64[s]')
+    return dates.astype(np.int64)
+
+
+
+#WxO CSV files in csvdir, in numerical (chronological) order
+def csv_files(csvdir):
+    return sorted(file for file in os.listdir(csvdir) if file[:3] == "WxO")
+
+
+
+#epoch, raw columns and qcflags of the stored observations in the history_seconds before epoch start,
+#the context for quality control and derive()
+def stored_history(start):
+    query = select(cast(func.strftime('%s', wxobs.date), Integer), *[getattr(wxobs, var) for var in OB_VARS], wxobs.qcflags).where(
+        (wxobs.date >= datetime.utcfromtimestamp(start - history_seconds)) & (wxobs.date < datetime.utcfromtimestamp(start)))
+    data = rows_array(db.session.execute(query).all(), len(OB_VARS) + 2)
+    return data[:,0].astype(np.int64), {var:data[:,i+1] for i,var in enumerate(OB_VARS)}, data[:,-1].astype(np.int64)
+
+
+
+#SQLAlchemy's SQLite DateTime format for epoch seconds
+def sqlite_dates(epoch):
+    return np.char.replace(np.datetime_as_string(epoch.astype('datetime64[s]'), unit='us'), 'T', ' ')
+
+
+
+#observations (epoch, columns) without repeated dates or dates already in wxobs (e.g. posted live through /addnewob)
+def unstored_observations(epoch, columns):
+    if len(epoch) == 0:
+        return epoch, columns
+    query = select(cast(func.strftime('%s', wxobs.date), Integer)).where(
+        (wxobs.date >= datetime.utcfromtimestamp(int(epoch.min()))) & (wxobs.date <= datetime.utcfromtimestamp(int(epoch.max()))))
+    stored = np.array(db.session.execute(query).scalars().all(), dtype=np.int64)
+    _, first = np.unique(epoch, return_index=True)
+    keep = np.sort(first[~np.isin(epoch[first], stored)])
+    return epoch[keep], {var:values[keep] for var,values in columns.items()}
+
+
+
+#inserts one parsed file in chunk_size executemany batches and records it as imported (one transaction per file)
+#quality control and derived quantities run over the whole file at once, continuing from the stored observations before it
+#skip is the number of the file's lines imported before (a file still being written when it was last imported)
+#returns the number of observations inserted
+def import_file(filename, epoch, columns, skip=0):
+
+    lines = len(epoch)
+    epoch, columns = unstored_observations(epoch[skip:], {var:values[skip:] for var,values in columns.items()})
+    if len(epoch) == 0: #recorded so the file isn't read again until it changes
+        db.session.merge(wximports(filename=filename, rows=lines, imported=datetime.utcnow()))
+        db.session.commit()
+        return 0
+
+    dates = sqlite_dates(epoch)
+    connection = db.session.connection()
+
+    historyepoch, historycolumns, historyflags = stored_history(int(epoch.min()))
+    n = len(historyepoch)
+    flags = qc_flags(np.concatenate((historyepoch, epoch)), {var:np.concatenate((historycolumns[var], columns[var])) for var in OB_VARS})
+    recheck = historyflags | flags[:n] #stored observations only gain flags (see qc.py)
+    changed = np.flatnonzero(recheck != historyflags)
+    if len(changed) > 0:
+        connection.exec_driver_sql("UPDATE wxobs SET qcflags = ? WHERE date = ?", list(zip(recheck[changed].tolist(), sqlite_dates(historyepoch[changed]).tolist())))
+    flags = flags[n:]
+
+    masked, historymasked = mask_flagged(columns, flags), mask_flagged(historycolumns, recheck)
+    derived = derive(epoch, masked, (historyepoch, historymasked), app.config['STATION_ELEVATION_M'])
+
+    names = OB_VARS + ['qcflags'] + DERIVED_VARS
+    statement = f"INSERT OR IGNORE INTO wxobs (date, {', '.join(names)}) VALUES ({', '.join(['?']*(len(names) + 1))})"
+    for start in range(0, len(epoch), chunk_size):
+        end = start + chunk_size
+        #NaN (undefined pressure tendency) is stored by SQLite as NULL
+        rows = zip(dates[start:end].tolist(), *[columns[var][start:end].tolist() for var in OB_VARS], flags[start:end].tolist(),
+                   *[derived[var][start:end].tolist() for var in DERIVED_VARS])
+        connection.exec_driver_sql(statement, list(rows))
+
+    update_rollups(db.session, epoch, masked)
+    if len(changed) > 0: #after this file's observations are in, since they may share buckets
+        rebuild_buckets(db.session, historyepoch[changed])
+    db.session.merge(wximports(filename=filename, rows=lines, imported=datetime.utcnow()))
+    db.session.commit()
+
+    if obStore is not None: #OBS_BACKEND = colstore
+        obStore.append(epoch, masked)
+    return len(epoch)
+
+
 
 
 if __name__ == "__main__":
-    
-    #reading CSV files (WxStation formatted) into lists by variable
-    csvdir = "../wxdata/initdata_2024/"
-    dates, ta, rh, pres, wspd, wgust, wdir, solar, precip, strikes = csv_to_lists(csvdir)
-    
-    #creating db
-    if os.path.exists('instance/wxobs.db'):
-        os.remove('instance/wxobs.db')
-        
+
+    parser = argparse.ArgumentParser(description="Imports WxStation CSV files into instance/wxobs.db")
+    parser.add_argument("csvdir", nargs="?", default="../wxdata/initdata_2024/", help="directory of WxO*.csv files")
+    parser.add_argument("--rebuild", action="store_true", help="delete the database and import every file again")
+    parser.add_argument("--rollups", action="store_true", help="only rebuild the hourly/daily rollup tables")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to parse files")
+    args = parser.parse_args()
+
     app.app_context().push()
+
+    if not rollups_current(db.session) and not args.rebuild:
+        sys.exit("Rollup tables predate quality control- run migratedb.py first")
+
+    if args.rollups:
+        rebuild_rollups(db.session)
+        db.session.commit()
+        sys.exit(0)
+
+    #creating db (app import already opened the old file, so drop pooled connections first)
+    db.engine.dispose()
+    writeSession.kw['bind'].dispose()
+    if args.rebuild:
+        for suffix in ['', '-wal', '-shm']: #WAL mode keeps uncheckpointed pages beside the database file
+            if os.path.exists('instance/wxobs.db' + suffix):
+                os.remove('instance/wxobs.db' + suffix)
+        if obStore is not None:
+            obStore.clear()
+
     db.create_all()
-    
-    #appending data to database
-    from app import wxobs
-    
-    #adding all entries to db
-    i = 0
-    for (cdate,cta,crh,cpres,cwspd,cwgust,cwdir,csolar,cprecip,cstrikes) in zip(dates, ta, rh, pres, wspd, wgust, wdir, solar, precip, strikes):
-        i += 1
-        entry = wxobs(id=i, date=cdate, temp=cta, rh=crh, pres=cpres, wspd = cwspd, wgust = cwgust, wdir = cwdir, precip=cprecip, solar=csolar, strikes=cstrikes)
-        db.session.add(entry)
-        
-    db.session.commit()
-    
 
+    #files that haven't been imported yet, and imported files written to since (e.g. today's file), resumed after their imported lines
+    csvdir = os.path.join(args.csvdir, "")
+    imported = {row.filename:(row.rows, row.imported) for row in wximports.query}
+    files = [file for file in csv_files(csvdir) if file not in imported or datetime.utcfromtimestamp(os.path.getmtime(csvdir + file)) > imported[file][1]]
+    print(f"Importing {len(files)} new or updated files ({len(imported)} imported before)")
+
+    #files are parsed in parallel and inserted in order, with at most 2 parsed files per worker held in memory
+    nrows = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        pending = []
+        for file in files + [None]*2*args.workers: #trailing Nones drain the pending parses
+            if file is not None:
+                pending.append((file, pool.submit(readfile, csvdir + file)))
+            if pending and (len(pending) > 2*args.workers or file is None):
+                cfile, future = pending.pop(0)
+                epoch, columns = future.result()
+                inserted = import_file(cfile, epoch, columns, imported.get(cfile, (0,))[0])
+                nrows += inserted
+                print(f"{cfile}: {inserted} new observations")
 
+    #caching first/last dates for /historical
+    refresh_date_bounds(db.session)
+    db.session.commit()
+    print(f"Imported {nrows} observations")
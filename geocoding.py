@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+
+from geopy.geocoders import Nominatim
+
+
+
+#######################################################################################
+#                                REVERSE GEOCODING                                    #
+#######################################################################################
+
+
+#turns lat/lon into a place name on a background thread, caching results on disk by position rounded
+#to precision decimal places (0.01 deg ~ 1 km) so a station revisiting an area never repeats a lookup
+#geocoder is anything with geopy's reverse(query, language=) interface (e.g. a stub for testing)
+class ReverseGeocoder():
+
+    def __init__(self, cachefile, on_result, geocoder=None, precision=2, timeout=10):
+        self.cachefile = cachefile
+        self.on_result = on_result #called as on_result(latitude, longitude, locationstr) from the worker thread
+        self.geocoder = geocoder
+        self.precision = precision
+        self.timeout = timeout
+        self.cache = self.load_cache()
+        self.pending = None #only the newest position waiting for a lookup matters
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="ReverseGeocoder", daemon=True)
+        self.thread.start()
+
+
+    def load_cache(self):
+        try:
+            with open(self.cachefile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def save_cache(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cachefile)), exist_ok=True)
+        tmpfile = self.cachefile + ".tmp"
+        with open(tmpfile, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmpfile, self.cachefile) #atomic, so a crash never leaves a truncated cache
+
+
+    def key(self, latitude, longitude):
+        return f"{round(float(latitude), self.precision):.{self.precision}f},{round(float(longitude), self.precision):.{self.precision}f}"
+
+
+    #returns the cached place name, or None after queueing a background lookup
+    def lookup(self, latitude, longitude):
+        locationstr = self.cache.get(self.key(latitude, longitude))
+        if locationstr is None:
+            with self.condition:
+                self.pending = (latitude, longitude)
+                self.condition.notify()
+        return locationstr
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                latitude, longitude = self.pending
+                self.pending = None
+
+            try:
+                if self.geocoder is None:
+                    self.geocoder = Nominatim(user_agent="geoapiExercises", timeout=self.timeout)
+                location = self.geocoder.reverse(f"{latitude},{longitude}", language="en")
+                locationstr = parse_address(location.raw['address']) if location is not None else ""
+            except Exception as e: #network errors/timeouts- keep showing lat/lon, retried on the next update
+                print(f"[ReverseGeocoder] lookup failed for {latitude},{longitude}: {e}")
+                continue
+
+            self.cache[self.key(latitude, longitude)] = locationstr
+            self.save_cache()
+            self.on_result(latitude, longitude, locationstr)
+
+
+
+#"City, State" (plus ", Country" outside the US) from a Nominatim address dictionary
+def parse_address(l):
+    outputstr = ""
+
+    p1 = "none"
+    priority = ['city','town','village','county','hamlet','suburb','neighborhood','road']
+    for item in priority:
+        if item in l:
+            outputstr += l[item] + ", "
+            p1 = item
+            break
+
+    priority = ['state','state-district','province']
+    if p1.lower() != 'county':
+        priority.append('county')
+    for item in priority:
+        if item in l:
+            outputstr += l[item]
+            break
+
+    if 'country' in l and l['country'].lower() != 'united states':
+        outputstr += ", " + l['country']
+
+    return outputstr
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import contextlib
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import numpy as np
+
+from flask import g, request, has_request_context, template_rendered, before_render_template, Response
+
+
+
+#######################################################################################
+#                                  INSTRUMENTATION                                    #
+#######################################################################################
+
+#requests are split into stages (query, decimate, plot, render...) by span()/timed(). Each response gets a
+#Server-Timing header with its stage durations (shown in the browser's network panel), and every duration
+#goes into per-route histograms served at /metrics in the Prometheus text format. Histograms are kept per
+#process, so each series carries a worker label.
+
+
+#histogram bucket upper bounds (seconds)
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, np.inf]
+
+
+class Histogram():
+
+    def __init__(self):
+        self.counts = np.zeros(len(BUCKETS), dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[np.searchsorted(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    #Prometheus exposition lines for this histogram (cumulative buckets)
+    def lines(self, name, labels):
+        lines = []
+        for edge, count in zip(BUCKETS, np.cumsum(self.counts)):
+            le = "+Inf" if np.isinf(edge) else f"{edge:g}"
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.counts.sum()}')
+        return lines
+
+
+
+class Instrumentation():
+
+    #authorize(credential) decides who may profile a request with an X-Profile: <credential> header
+    #(never a query parameter, which would leave the credential in access logs and browser history)
+    def __init__(self, app, authorize=None, profile_lines=60):
+        self.authorize = authorize
+        self.profile_lines = profile_lines #functions listed in a profile report
+        self.requests = {} #route: Histogram of whole requests
+        self.stages = {} #(route, stage): Histogram
+        self.values = {} #name: (Prometheus type, function returning the current value), see value()
+        self.lock = threading.Lock()
+        self.labels = f'worker="{os.getpid()}"'
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+
+
+    #per-request timing state- kept in the WSGI environ rather than g, since views push their own app contexts
+    def request_state(self):
+        return request.environ.setdefault('wxserver.timing', {'spans': {}, 'open': set(), 'renders': []})
+
+
+    #times a stage of the current request (or background work); nested spans of the same stage count once
+    @contextlib.contextmanager
+    def span(self, stage):
+        openspans = self.request_state()['open'] if has_request_context() else set()
+        if stage in openspans:
+            yield
+            return
+        openspans.add(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            openspans.discard(stage)
+            self.record(stage, time.perf_counter() - start)
+
+
+    #decorator form of span()
+    def timed(self, stage):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    #adds a gauge or counter (kind) to /metrics, read from function() at every scrape
+    def value(self, name, function, kind='gauge'):
+        self.values[name] = (kind, function)
+
+
+    def record(self, stage, seconds):
+        route = request.url_rule.rule if has_request_context() and request.url_rule else "background"
+        with self.lock:
+            self.stages.setdefault((route, stage), Histogram()).observe(seconds)
+        if has_request_context():
+            spans = self.request_state()['spans']
+            spans[stage] = spans.get(stage, 0) + seconds
+
+
+    #templates rendered within templates (or within a plot) are part of the outer render
+    def start_render(self, sender, template, context, **extra):
+        self.request_state()['renders'].append(time.perf_counter())
+
+    def finish_render(self, sender, template, context, **extra):
+        starts = self.request_state()['renders']
+        if starts:
+            start = starts.pop()
+            if not starts:
+                self.record('render', time.perf_counter() - start)
+
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        credential = request.headers.get('X-Profile')
+        if credential and self.authorize and self.authorize(credential):
+            g.nocache = True #the response cache would skip the work being profiled
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+
+    def finish_request(self, response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+        if 'request_start' in g and request.url_rule is not None:
+            total = time.perf_counter() - g.request_start
+            with self.lock:
+                self.requests.setdefault(request.url_rule.rule, Histogram()).observe(total)
+            timings = [f"{stage};dur={1000*seconds:.1f}" for stage, seconds in self.request_state()['spans'].items()]
+            response.headers['Server-Timing'] = ", ".join(timings + [f"total;dur={1000*total:.1f}"])
+
+        if profiler is not None: #the report replaces the page
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(self.profile_lines)
+            response = Response(report.getvalue(), mimetype='text/plain')
+        return response
+
+
+    def metrics(self):
+        lines = ["# TYPE wxserver_request_seconds histogram"]
+        with self.lock:
+            for route, histogram in sorted(self.requests.items()):
+                lines += histogram.lines("wxserver_request_seconds", f'route="{route}",{self.labels}')
+            lines.append("# TYPE wxserver_stage_seconds histogram")
+            for (route, stage), histogram in sorted(self.stages.items()):
+                lines += histogram.lines("wxserver_stage_seconds", f'route="{route}",stage="{stage}",{self.labels}')
+        for name, (kind, function) in sorted(self.values.items()):
+            lines += [f"# TYPE {name} {kind}", f"{name}{{{self.labels}}} {function()}"]
+        return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+#upgrades an existing instance/wxobs.db in place: python migratedb.py [--rollups] [--qc] [--derived]
+# - creates any missing tables (rollups, metadata), and recreates rollup tables from before quality control
+# - adds the unique date index that every route's range scan relies on (removing observations stored twice)
+# - caches the earliest/latest observation dates in wxmeta
+# - optionally reruns quality control (qc.py) over every stored observation
+# - optionally rebuilds the hourly/daily rollup tables from wxobs (always after --qc)
+# - optionally computes the derived quantities (dewpoint, feels like...) of every stored observation
+
+import sys
+import numpy as np
+from datetime import timedelta
+from sqlalchemy import text, select, func, cast, Integer
+
+from app import app, db, wxobs, refresh_date_bounds
+from rollups import ROLLUPS, rollups_current, rebuild_rollups
+from observations import OB_VARS, rows_array
+from qc import qc_flags, mask_flagged, history_seconds as qc_history_seconds
+from derived import DERIVED_VARS, derive, history_seconds as derived_history_seconds
+
+
+#makes ix_wxobs_date (missing or not unique in older databases) a unique index, first deleting every observation
+#stored more than once (e.g. imported by gendb.py and posted through /addnewob) but the earliest row
+#returns the number of rows deleted
+def unique_date_index(session):
+    indexes = {row[1]:row[2] for row in session.execute(text("PRAGMA index_list(wxobs)"))} #name: unique
+    if indexes.get('ix_wxobs_date'):
+        return 0
+    removed = session.execute(text("DELETE FROM wxobs WHERE id NOT IN (SELECT min(id) FROM wxobs GROUP BY date)")).rowcount
+    session.execute(text("DROP INDEX IF EXISTS ix_wxobs_date"))
+    session.execute(text("CREATE UNIQUE INDEX ix_wxobs_date ON wxobs (date)"))
+    return removed
+
+
+#days of observations rechecked/derived per transaction
+rebuild_batch_days = 30
+
+
+#recomputes the qcflags and/or derived columns of wxobs in date order, batch by batch, with the end of each batch as
+#the context for the next. Flags are rebuilt from scratch, and derived quantities use the values left after QC masking.
+def rebuild_observations(session, earliest, latest, qc=True, derived=True):
+
+    context_seconds = max(qc_history_seconds, derived_history_seconds)
+    contextids, contextepoch, contextcolumns, contextflags = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), {var:np.zeros(0) for var in OB_VARS}, np.zeros(0, dtype=np.int64)
+    names = (['qcflags'] if qc else []) + (DERIVED_VARS if derived else [])
+    statement = f"UPDATE wxobs SET {', '.join(f'{name} = ?' for name in names)} WHERE id = ?"
+
+    start = earliest
+    while start <= latest:
+        end = start + timedelta(days=rebuild_batch_days)
+        query = select(wxobs.id, cast(func.strftime('%s', wxobs.date), Integer), *[getattr(wxobs, var) for var in OB_VARS], wxobs.qcflags).where(
+            (wxobs.date >= start) & (wxobs.date < end)).order_by(wxobs.date)
+        data = rows_array(session.execute(query).all(), len(OB_VARS) + 3)
+        ids, epoch, flags = data[:,0].astype(np.int64), data[:,1].astype(np.int64), data[:,-1].astype(np.int64)
+        columns = {var:data[:,i+2] for i,var in enumerate(OB_VARS)}
+        updates = {}
+
+        if qc:
+            n = len(contextepoch)
+            allflags = qc_flags(np.concatenate((contextepoch, epoch)), {var:np.concatenate((contextcolumns[var], columns[var])) for var in OB_VARS})
+            recheck = contextflags | allflags[:n] #e.g. a spike at the end of the previous batch
+            changed = np.flatnonzero(recheck != contextflags)
+            if len(changed) > 0:
+                session.connection().exec_driver_sql("UPDATE wxobs SET qcflags = ? WHERE id = ?", list(zip(recheck[changed].tolist(), contextids[changed].tolist())))
+            contextflags, flags = recheck, allflags[n:]
+            updates['qcflags'] = flags
+
+        if derived:
+            history = (contextepoch, mask_flagged(contextcolumns, contextflags))
+            updates.update(derive(epoch, mask_flagged(columns, flags), history, app.config['STATION_ELEVATION_M']))
+
+        if len(ids) > 0:
+            session.connection().exec_driver_sql(statement, list(zip(*[updates[name].tolist() for name in names], ids.tolist()))) #NaN is stored as NULL
+        session.commit()
+
+        if len(epoch) > 0:
+            keep = epoch >= epoch[-1] - context_seconds
+            contextids, contextepoch, contextflags = ids[keep], epoch[keep], flags[keep]
+            contextcolumns = {var:values[keep] for var,values in columns.items()}
+        start = end
+
+
+def migrate(rollups=False, qc=False, derived=False):
+
+    outdated = not rollups_current(db.session)
+    if outdated:
+        for tablename in ROLLUPS:
+            db.session.execute(text(f"DROP TABLE IF EXISTS {tablename}"))
+        db.session.commit()
+    db.create_all()
+
+    print("Creating unique index ix_wxobs_date")
+    duplicates = unique_date_index(db.session)
+    db.session.commit()
+    if duplicates:
+        print(f"Removed {duplicates} duplicate observations")
+
+    earliest, latest = refresh_date_bounds(db.session)
+    db.session.commit()
+    print(f"Observations span {earliest} to {latest}")
+
+    if qc or derived:
+        print("Rebuilding " + " and ".join((["quality control flags"] if qc else []) + (["derived quantities"] if derived else [])))
+        rebuild_observations(db.session, earliest, latest, qc, derived)
+
+    if rollups or qc or duplicates or outdated: #rollups only aggregate values that pass quality control, and count each observation once
+        print(f"Rebuilding rollup tables: {', '.join(ROLLUPS)}")
+        rebuild_rollups(db.session)
+        db.session.commit()
+
+    db.session.execute(text("ANALYZE")) #refresh query planner statistics for the new index
+    db.session.commit()
+
+    #show the plan for a typical range query so the index use can be confirmed
+    plan = db.session.execute(text("EXPLAIN QUERY PLAN SELECT * FROM wxobs WHERE date >= '2000-01-01' ORDER BY date")).all()
+    print("Range query plan: " + "; ".join(str(row[-1]) for row in plan))
+
+
+
+if __name__ == "__main__":
+    app.app_context().push()
+    migrate(rollups="--rollups" in sys.argv, qc="--qc" in sys.argv, derived="--derived" in sys.argv)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import numpy as np
+
+
+
+#######################################################################################
+#                               COLUMNAR OBSERVATIONS                                 #
+#######################################################################################
+
+
+#measured variables for every observation, in the order they are selected from wxobs
+OB_VARS = ['temp', 'rh', 'pres', 'wspd', 'wgust', 'wdir', 'precip', 'solar', 'strikes']
+
+#variables shown in the observation tables and their printf-style formatting
+TABLE_FORMATS = {'temp':'%.1f', 'rh':'%.1f', 'pres':'%.1f', 'wspd':'%.1f', 'wgust':'%.1f', 'wdir':'%.0f', 'precip':'%.1f', 'strikes':'%.0f'}
+
+
+#float64 array of database rows (None -> NaN), width values per row. The rows are converted to tuples first:
+#NumPy probes each SQLAlchemy Row for the array protocols, which costs far more than reading it
+def rows_array(rows, width):
+    return np.array([tuple(row) for row in rows], dtype=np.float64).reshape(-1, width)
+
+
+#single observation (used for the "current conditions" table and JSON API)
+class ObservationList():
+    def __init__(self, date, temp, rh, pres, wspd, wgust, wdir, precip, solar, strikes):
+        self.date = date
+        self.temp = temp
+        self.rh = rh
+        self.pres = pres
+        self.wspd = wspd
+        self.wgust = wgust
+        self.wdir = wdir
+        self.precip = precip
+        self.solar = solar
+        self.strikes = strikes
+
+
+
+#stores a set of observations as one numpy array per variable
+#epoch is UTC seconds (int64), date is local wall-clock time (datetime64[s]), temp is in F
+#variables are float64, or float32 views when read from the column store (colstore.py)
+class ObservationArrays():
+
+    def __init__(self, epoch, columns, tzinfo):
+        self.tzinfo = tzinfo
+        self.epoch = np.asarray(epoch, dtype=np.int64)
+        self.offsets = utc_offsets(self.epoch, tzinfo)
+        self.date = (self.epoch + self.offsets).astype('datetime64[s]')
+        for var in OB_VARS:
+            values = np.asarray(columns[var])
+            setattr(self, var, values if values.dtype.kind == 'f' else values.astype(np.float64))
+        self.extremes = {} #optional per-variable min/max envelopes (see decimate.py)
+
+
+    #builds arrays from (epoch, temp[C], rh, pres, ...) rows as returned by a wxobs SELECT
+    @classmethod
+    def from_rows(cls, rows, tzinfo):
+        data = rows_array(rows, len(OB_VARS) + 1)
+        columns = {var:data[:,i+1] for i,var in enumerate(OB_VARS)}
+        columns['temp'] = columns['temp']*9/5 + 32 #convert to F
+        return cls(data[:,0].astype(np.int64), columns, tzinfo)
+
+
+    def __len__(self):
+        return len(self.epoch)
+
+
+    #observations selected by a slice/index array (slices are views, not copies)
+    def __getitem__(self, index):
+        subset = ObservationArrays.__new__(ObservationArrays)
+        subset.tzinfo = self.tzinfo
+        for attr in ['epoch', 'offsets', 'date'] + OB_VARS:
+            setattr(subset, attr, getattr(self, attr)[index])
+        subset.extremes = {key:values[index] for key,values in self.extremes.items()}
+        return subset
+
+
+    #returns observation i as a single ObservationList with a timezone-aware date
+    def ob(self, i):
+        date = datetime.fromtimestamp(int(self.epoch[i]), tz=self.tzinfo)
+        return ObservationList(date, *[float(getattr(self, var)[i]) for var in OB_VARS])
+
+
+    #JSON-serializable columns (dates as bokeh's milliseconds of local time) for streaming to the browser
+    def json_data(self):
+        data = {var:json_values(getattr(self, var)) for var in OB_VARS}
+        data.update({key:json_values(values) for key,values in self.extremes.items()})
+        data['date'] = self.date.astype('datetime64[ms]').astype(np.int64).tolist()
+        return data
+
+
+    #formatted (date, temp, rh, pres, wspd, wgust, wdir, precip, strikes) string rows for HTML tables ("-" for masked values)
+    def table_rows(self):
+        if len(self) == 0: #numpy string functions can't reduce empty arrays
+            return iter([])
+        dates = np.char.replace(np.datetime_as_string(self.date, unit='m'), 'T', ' ')
+        columns = [np.where(np.isnan(getattr(self, var)), '-', np.char.mod(fmt, getattr(self, var))) for var,fmt in TABLE_FORMATS.items()]
+        return zip(dates, *columns)
+
+
+
+#list of floats for JSON (float32 values are rounded so they don't print as e.g. 20.100000381469727),
+#with None for NaN (values masked by quality control)
+def json_values(values):
+    if values.dtype == np.float32:
+        values = np.round(values.astype(np.float64), 4)
+    if values.dtype.kind == 'f' and np.isnan(values).any():
+        return np.where(np.isnan(values), None, values).tolist()
+    return values.tolist()
+    
+    
+    
+#UTC offset (seconds) for each epoch time, evaluated once per distinct hour rather than per observation
+def utc_offsets(epoch, tzinfo):
+    if len(epoch) == 0:
+        return np.zeros(0, dtype=np.int64)
+    hours, inverse = np.unique(epoch//3600, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(int(h)*3600, tz=tzinfo).utcoffset().total_seconds() for h in hours], dtype=np.int64)
+    return offsets[inverse.reshape(-1)]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+
+
+#######################################################################################
+#                                WRITE-BEHIND QUEUE                                   #
+#######################################################################################
+
+#uploads are acknowledged before they are written, so failures go to this logger (warnings and errors reach the
+#server's stderr log even without logging configuration) and to the counters shown on /metrics
+log = logging.getLogger("wxserver.obwriter")
+
+
+#collects observations from request handlers and hands them to write_batch(list) from a background
+#thread, grouping everything that arrives within max_delay seconds (up to max_batch) into one call.
+#write_batch must be all-or-nothing (one transaction): a failed batch is retried with backoff (e.g. through
+#a locked database) for up to max_retries attempts, then written one observation at a time so that only
+#observations the database rejects outright are lost
+class ObservationWriter():
+
+    def __init__(self, write_batch, max_batch=1000, max_delay=0.25, max_retries=8, retry_delay=0.5, max_retry_delay=30):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.errors = 0 #failed write attempts
+        self.failed = 0 #observations dropped after every retry failed
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="ObservationWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+
+    #queues observations for writing (returns immediately)
+    def submit(self, obs):
+        for ob in obs:
+            self.queue.put(ob)
+
+
+    #blocks until everything submitted so far has been written
+    def flush(self):
+        self.queue.join()
+
+
+    #observations submitted but not yet written
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                if not self.write_with_retries(batch) and len(batch) > 1:
+                    for ob in batch: #isolate the observations the database rejects
+                        self.write_with_retries([ob])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+    #True once write_batch(batch) succeeds, False if every attempt failed
+    def write_with_retries(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries):
+            try:
+                self.write_batch(batch)
+                return True
+            except Exception as e: #a failed batch must not kill the writer thread
+                self.errors += 1
+                log.warning(f"failed to write {len(batch)} observations (attempt {attempt + 1} of {self.max_retries}): {e}")
+            if attempt + 1 < self.max_retries:
+                time.sleep(delay)
+                delay = min(2*delay, self.max_retry_delay)
+        if len(batch) == 1:
+            self.failed += 1
+            log.error(f"dropped observation {batch[0][0]} after {self.max_retries} failed writes: {batch[0][1]}")
+        return False
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from observations import OB_VARS
+
+
+
+#######################################################################################
+#                                 QUALITY CONTROL                                     #
+#######################################################################################
+
+#every observation gets a qcflags bitmask (wxobs.qcflags) with the bit of each variable that failed a check
+#(QC_BITS), so reads can mask or skip bad values in SQL without rerunning the checks. The checks run over
+#whole arrays: in batch for gendb.py imports (and migratedb.py --qc), and on ingest over the recent window,
+#since a spike is only recognisable once the observation after it has arrived. Rechecking earlier observations
+#only ever adds flags (their window lacks older context, so a stuck run could look shorter than it was).
+#values are in raw wxobs units (temp in C)
+
+
+QC_BITS = {var:1 << i for i,var in enumerate(OB_VARS)}
+
+#physically plausible ranges
+LIMITS = {'temp': (-50, 60), 'rh': (0, 100), 'pres': (500, 1100), 'wspd': (0, 150), 'wgust': (0, 200), 'wdir': (0, 360),
+          'precip': (0, 400), 'solar': (0, 1500), 'strikes': (0, 100000)}
+
+#largest believable change per minute (steps and spikes)
+STEP_LIMITS = {'temp': 2.0, 'rh': 10.0, 'pres': 1.0}
+
+#seconds a value may stay exactly unchanged before the sensor is considered stuck
+PERSISTENCE_SECONDS = {'temp': 7200, 'rh': 14400, 'pres': 7200}
+saturated_rh = 99 #fog can hold rh at 100% for hours
+
+#observations further apart than this (seconds) aren't compared for steps and spikes
+max_step_interval = 600
+
+#seconds of earlier observations the checks need for context (more than the longest persistence limit)
+history_seconds = max(PERSISTENCE_SECONDS.values()) + 3600
+
+
+
+#{var: failed} for values outside LIMITS (NaN fails)
+def range_check(epoch, columns):
+    return {var:~((columns[var] >= low) & (columns[var] <= high)) for var,(low, high) in LIMITS.items()}
+
+
+#{var: failed} for observations that jump away from both neighbours (spikes), or away from a previous
+#observation that isn't itself a spike (steps); epoch must be sorted
+def step_check(epoch, columns):
+    minutes = np.maximum(np.diff(epoch), 60)/60
+    close = np.diff(epoch) <= max_step_interval
+    failed = {}
+    for var, limit in STEP_LIMITS.items():
+        values = columns[var]
+        change = np.diff(values)
+        jump = close & (np.abs(change) > limit*minutes) #jump[i]: between observations i and i+1
+        spike = np.zeros(len(values), dtype=bool)
+        spike[1:-1] = jump[:-1] & jump[1:] & (np.sign(change[:-1]) != np.sign(change[1:])) & \
+                      (np.abs(values[2:] - values[:-2]) <= limit*(minutes[:-1] + minutes[1:]))
+        step = np.zeros(len(values), dtype=bool)
+        step[1:] = jump & ~spike[:-1]
+        failed[var] = spike | step
+    return failed
+
+
+#{var: failed} for values unchanged for longer than PERSISTENCE_SECONDS (the whole run is flagged); epoch must be sorted
+def persistence_check(epoch, columns):
+    failed = {}
+    for var, seconds in PERSISTENCE_SECONDS.items():
+        values = columns[var]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(values) != 0) + 1)) #runs of equal values
+        ends = np.append(starts[1:], len(values)) - 1
+        stuck = (epoch[ends] - epoch[starts]) > seconds
+        failed[var] = np.repeat(stuck, ends - starts + 1)
+        if var == 'rh':
+            failed[var] &= values < saturated_rh
+    return failed
+
+
+#{var: failed} for variables that contradict each other: gusts below the mean wind, rain in very dry air
+def consistency_check(epoch, columns):
+    calm = columns['wgust'] < columns['wspd']
+    dryrain = (columns['precip'] > 0) & (columns['rh'] < 20)
+    return {'wspd': calm, 'wgust': calm, 'precip': dryrain}
+
+
+CHECKS = [range_check, step_check, persistence_check, consistency_check]
+
+
+
+#qcflags for observations (epoch seconds, {var: raw array}, any order)
+def qc_flags(epoch, columns):
+    epoch = np.asarray(epoch, dtype=np.int64)
+    order = np.argsort(epoch, kind='stable')
+    sortedepoch = epoch[order]
+    values = {var:np.asarray(columns[var], dtype=np.float64)[order] for var in OB_VARS}
+
+    flags = np.zeros(len(epoch), dtype=np.int64)
+    if len(epoch) == 0:
+        return flags
+    with np.errstate(invalid='ignore'): #NaN comparisons
+        for qccheck in CHECKS:
+            for var, failed in qccheck(sortedepoch, values).items():
+                flags[failed] |= QC_BITS[var]
+
+    unsorted = np.empty_like(flags)
+    unsorted[order] = flags
+    return unsorted
+
+
+#copies of columns with the flagged values replaced by NaN
+def mask_flagged(columns, flags):
+    flags = np.asarray(flags, dtype=np.int64)
+    return {var:np.where(flags & QC_BITS[var], np.nan, np.asarray(values, dtype=np.float64)) if var in QC_BITS else values
+            for var,values in columns.items()}
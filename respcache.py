@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+from flask import g, request, make_response, Response
+
+
+
+#######################################################################################
+#                                  RESPONSE CACHE                                     #
+#######################################################################################
+
+
+class CachedResponse():
+    def __init__(self, body, mimetype, created):
+        self.body = body
+        self.mimetype = mimetype
+        self.created = created
+        self.etag = sha1(body).hexdigest()
+
+
+
+#LRU cache of rendered GET responses, bounded by entry count and total body size
+#entries also expire after ttl seconds since pages show relative times ("lightning 5 minutes ago")
+class ResponseCache():
+
+    def __init__(self, max_entries=256, max_bytes=32*1024*1024, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.generation = 0 #incremented by every invalidation
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created > self.ttl:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+
+    #stores a response unless the cache was invalidated while it was being rendered
+    def put(self, key, body, mimetype, generation):
+        entry = CachedResponse(body, mimetype, time.monotonic())
+        with self.lock:
+            if generation != self.generation or len(body) > self.max_bytes:
+                return entry
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.nbytes += len(body)
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self.remove(next(iter(self.entries))) #least recently used
+        return entry
+
+
+    def remove(self, key):
+        self.nbytes -= len(self.entries.pop(key).body)
+
+
+    #drops every cached page (called whenever observations, strikes or location change)
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.generation += 1
+
+
+    #decorator caching a GET route by path, query args and vary() (e.g. the mobile flag), with ETag/304 support
+    def cached(self, vary=None):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+
+                if request.method != 'GET' or g.get('nocache'): #e.g. requests being profiled
+                    return view(*args, **kwargs)
+
+                key = (request.path, tuple(sorted(request.args.items(multi=True))), vary() if vary else None)
+                entry = self.get(key)
+                if entry is None:
+                    generation = self.generation
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    entry = self.put(key, response.get_data(), response.mimetype, generation)
+
+                response = Response(entry.body, mimetype=entry.mimetype)
+                response.set_etag(entry.etag)
+                response.cache_control.no_cache = True #browsers/clients revalidate with If-None-Match
+                return response.make_conditional(request)
+
+            return wrapper
+        return decorator
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import threading
+import numpy as np
+
+from observations import ObservationArrays, OB_VARS, rows_array
+from qc import mask_flagged
+
+
+
+#######################################################################################
+#                               RECENT OBSERVATIONS                                   #
+#######################################################################################
+
+
+#fixed-size buffer of the most recent observations (raw wxobs units) and their qcflags in preallocated arrays
+#complete_since is the earliest epoch from which the buffer is known to hold every observation
+#observations are returned with QC-flagged values masked (NaN), except by window()
+class ObservationRing():
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.epoch = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, len(OB_VARS)), dtype=np.float64)
+        self.flags = np.zeros(capacity, dtype=np.int64)
+        self.count = 0 #number of valid entries
+        self.head = 0 #next slot to write
+        self.complete_since = None
+        self.lock = threading.Lock()
+
+
+    #adds (epoch, temp, rh, ..., qcflags) rows covering everything since complete_since (e.g. reread from the database)
+    #to the buffered observations. Buffered observations missing from the rows (queued but not yet written) are kept,
+    #and the flags of observations in both are combined.
+    def merge(self, rows, complete_since):
+        data = rows_array(rows, len(OB_VARS) + 2)
+        with self.lock:
+            current = np.column_stack((self.epoch[:self.count], self.values[:self.count], self.flags[:self.count]))
+            data = np.concatenate((current, data))
+            epoch, first, inverse = np.unique(data[:,0].astype(np.int64), return_index=True, return_inverse=True) #sorted
+            flags = np.zeros(len(epoch), dtype=np.int64)
+            np.bitwise_or.at(flags, inverse.ravel(), data[:,-1].astype(np.int64))
+            epoch, values, flags = epoch[-self.capacity:], data[first,1:-1][-self.capacity:], flags[-self.capacity:]
+
+            n = len(epoch)
+            if self.complete_since is not None:
+                complete_since = min(complete_since, self.complete_since)
+            self.epoch[:n] = epoch
+            self.values[:n] = values
+            self.flags[:n] = flags
+            self.count = n
+            self.head = n % self.capacity
+            self.complete_since = complete_since if n < self.capacity else max(complete_since, int(self.epoch[0]))
+
+
+    #adds observations (epoch seconds, a dict of raw values per variable and their qcflags)
+    def extend(self, epoch, columns, flags):
+        epoch = np.atleast_1d(np.asarray(epoch, dtype=np.int64))
+        values = np.column_stack([np.atleast_1d(np.asarray(columns[var], dtype=np.float64)) for var in OB_VARS])
+        flags = np.atleast_1d(np.asarray(flags, dtype=np.int64))
+        with self.lock:
+            for i in range(len(epoch)):
+                if self.count == self.capacity: #overwriting the oldest entry
+                    self.complete_since = int(self.epoch[self.head]) + 1
+                self.epoch[self.head] = epoch[i]
+                self.values[self.head] = values[i]
+                self.flags[self.head] = flags[i]
+                self.head = (self.head + 1) % self.capacity
+                self.count = min(self.count + 1, self.capacity)
+
+
+    #True if every observation at or after epoch start is in the buffer
+    def covers(self, start):
+        return self.complete_since is not None and start >= self.complete_since
+
+
+    #ObservationArrays (newest first) of buffered observations at or after epoch start
+    def since(self, start, tzinfo):
+        epoch, columns, flags = self.window(start)
+        return self.masked(epoch[::-1], {var:values[::-1] for var,values in columns.items()}, flags[::-1], tzinfo)
+
+
+    #ObservationArrays holding only the most recent observation (empty if the buffer is empty)
+    def latest(self, tzinfo):
+        with self.lock:
+            newest = [np.argmax(self.epoch[:self.count])] if self.count else []
+            epoch, values, flags = self.epoch[newest], self.values[newest], self.flags[newest] #copies
+        return self.masked(epoch, {var:values[:,j] for j,var in enumerate(OB_VARS)}, flags, tzinfo)
+
+
+    #epoch, raw columns and qcflags (oldest first) of buffered observations at or after epoch start
+    def window(self, start):
+        with self.lock:
+            epoch = self.epoch[:self.count].copy()
+            values = self.values[:self.count].copy()
+            flags = self.flags[:self.count].copy()
+        keep = np.flatnonzero(epoch >= start)
+        keep = keep[np.argsort(epoch[keep], kind='stable')] #late uploads may arrive out of order
+        return epoch[keep], {var:values[keep,j] for j,var in enumerate(OB_VARS)}, flags[keep]
+
+
+    #replaces the qcflags of buffered observations (e.g. a spike recognised once the next observation arrived)
+    def set_flags(self, epoch, flags):
+        with self.lock:
+            position = {int(e):i for i,e in enumerate(self.epoch[:self.count])}
+            for e, flag in zip(epoch, flags):
+                if int(e) in position:
+                    self.flags[position[int(e)]] = flag
+
+
+    @staticmethod
+    def masked(epoch, columns, flags, tzinfo):
+        columns = mask_flagged(columns, flags)
+        columns['temp'] = columns['temp']*9/5 + 32 #convert to F
+        return ObservationArrays(epoch, columns, tzinfo)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+import numpy as np
+from sqlalchemy import text
+
+from observations import ObservationArrays, OB_VARS, rows_array
+from decimate import AGGREGATIONS, ENVELOPE_VARS
+from qc import mask_flagged
+
+
+
+#######################################################################################
+#                                  ROLLUP TABLES                                      #
+#######################################################################################
+
+
+#rollup tables and their bucket widths (seconds), finest first. Buckets are aligned to UTC.
+ROLLUPS = {'wxobs_hourly': 3600, 'wxobs_daily': 86400}
+
+#naive UTC epoch (wxobs dates are stored as naive UTC)
+EPOCH = datetime(1970,1,1)
+
+#scalar variables kept as count/min/max/sum in every bucket (wind direction is kept as summed unit vectors)
+#buckets only aggregate values that passed quality control: <var>_count is the number of valid values, and
+#min/max are NULL when there are none
+ROLLUP_VARS = [var for var in OB_VARS if var != 'wdir']
+
+#columns of every rollup table after the date
+ROLLUP_STATS = ['count', 'wdir_count', 'wdir_sin', 'wdir_cos'] + [f'{var}_{stat}' for var in ROLLUP_VARS for stat in ['count','min','max','sum']]
+
+
+#builds the SQLAlchemy model for a rollup table: one row per bucket, keyed by bucket start (UTC)
+def rollup_model(db, tablename):
+    attrs = {'__tablename__': tablename,
+             'date': db.Column(db.DateTime, primary_key=True),
+             'count': db.Column(db.Integer, nullable=False),
+             'wdir_count': db.Column(db.Integer, nullable=False),
+             'wdir_sin': db.Column(db.Float, nullable=False),
+             'wdir_cos': db.Column(db.Float, nullable=False)}
+    for var in ROLLUP_VARS:
+        attrs[f'{var}_count'] = db.Column(db.Integer, nullable=False)
+        attrs[f'{var}_min'] = db.Column(db.Float)
+        attrs[f'{var}_max'] = db.Column(db.Float)
+        attrs[f'{var}_sum'] = db.Column(db.Float, nullable=False)
+    return type(tablename, (db.Model,), attrs)
+
+
+
+#False for rollup tables created before quality control (no per-variable counts), which migratedb.py recreates
+def rollups_current(session):
+    return all('temp_count' in {row[1] for row in session.execute(text(f"PRAGMA table_info({tablename})"))} for tablename in ROLLUPS)
+
+
+
+#aggregates observations (epoch seconds + wxobs columns with values masked by quality control as NaN)
+#into per-bucket parameter dicts
+def rollup_rows(epoch, columns, seconds):
+
+    epoch = np.asarray(epoch, dtype=np.int64)
+    if len(epoch) == 0:
+        return []
+
+    order = np.argsort(epoch, kind='stable')
+    bucket = epoch[order]//seconds
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+
+    aggregates = {'date': [bucketdate(b*seconds) for b in bucket[starts]],
+                  'count': np.diff(np.append(starts, len(bucket)))}
+    for var in ROLLUP_VARS:
+        values = np.asarray(columns[var], dtype=np.float64)[order]
+        valid = ~np.isnan(values)
+        aggregates[var + '_count'] = np.add.reduceat(valid, starts)
+        aggregates[var + '_min'] = np.fmin.reduceat(values, starts) #NaN for buckets without valid values
+        aggregates[var + '_max'] = np.fmax.reduceat(values, starts)
+        aggregates[var + '_sum'] = np.add.reduceat(np.where(valid, values, 0), starts)
+    wdir = np.asarray(columns['wdir'], dtype=np.float64)[order]
+    valid = ~np.isnan(wdir)
+    rad = np.deg2rad(np.where(valid, wdir, 0))
+    aggregates['wdir_count'] = np.add.reduceat(valid, starts)
+    aggregates['wdir_sin'] = np.add.reduceat(np.where(valid, np.sin(rad), 0), starts)
+    aggregates['wdir_cos'] = np.add.reduceat(np.where(valid, np.cos(rad), 0), starts)
+
+    keys = list(aggregates.keys())
+    return [{key:(value if key == 'date' else sql_value(value.item())) for key,value in zip(keys, row)} for row in zip(*aggregates.values())]
+
+
+#NaN as NULL
+def sql_value(value):
+    return None if value != value else value
+
+
+#bucket start formatted the way SQLAlchemy stores DateTime columns in SQLite (so range comparisons line up)
+def bucketdate(epoch):
+    return np.datetime_as_string(np.datetime64(int(epoch), 's'), unit='us').replace('T', ' ')
+
+
+#INSERT that merges a partial bucket aggregate into an existing row
+#(SQLite's min()/max() of a NULL is NULL, so a bucket's NULL min/max is replaced rather than compared)
+def upsert_statement(tablename):
+    updates = []
+    for stat in ROLLUP_STATS:
+        if stat.endswith('_min'):
+            updates.append(f"{stat} = coalesce(min({stat}, excluded.{stat}), {stat}, excluded.{stat})")
+        elif stat.endswith('_max'):
+            updates.append(f"{stat} = coalesce(max({stat}, excluded.{stat}), {stat}, excluded.{stat})")
+        else:
+            updates.append(f"{stat} = {stat} + excluded.{stat}")
+    return text(f"INSERT INTO {tablename} (date, {', '.join(ROLLUP_STATS)}) VALUES (:date, {', '.join(':' + s for s in ROLLUP_STATS)}) "
+                f"ON CONFLICT(date) DO UPDATE SET {', '.join(updates)}")
+
+
+
+#epoch seconds and masked columns (see rollup_rows) of the wxobs observations from start up to end (bucketdate strings)
+def masked_observations(session, start, end):
+    query = text(f"SELECT CAST(strftime('%s', date) AS INTEGER), {', '.join(OB_VARS)}, qcflags FROM wxobs WHERE date >= :start AND date < :end")
+    data = rows_array(session.execute(query, {'start':start, 'end':end}).all(), len(OB_VARS) + 2)
+    return data[:,0].astype(np.int64), mask_flagged({var:data[:,i+1] for i,var in enumerate(OB_VARS)}, data[:,-1].astype(np.int64))
+
+
+
+#adds new observations (masked columns, see rollup_rows) to every rollup table (caller commits)
+def update_rollups(session, epoch, columns):
+    for tablename, seconds in ROLLUPS.items():
+        rows = rollup_rows(epoch, columns, seconds)
+        if rows:
+            session.execute(upsert_statement(tablename), rows)
+
+
+
+#recomputes the buckets holding the observations at epoch (seconds) from wxobs, e.g. after quality control
+#flagged them late (caller commits, after any new observations in those buckets have been added)
+def rebuild_buckets(session, epoch):
+    for tablename, seconds in ROLLUPS.items():
+        for bucket in np.unique(np.asarray(epoch, dtype=np.int64)//seconds):
+            start, end = bucketdate(bucket*seconds), bucketdate((bucket + 1)*seconds)
+            session.execute(text(f"DELETE FROM {tablename} WHERE date = :date"), {'date':start})
+            rows = rollup_rows(*masked_observations(session, start, end), seconds)
+            if rows:
+                session.execute(upsert_statement(tablename), rows)
+
+
+
+#recomputes all rollup tables from wxobs, reading chunk_seconds of observations at a time (caller commits)
+def rebuild_rollups(session, chunk_seconds=31*86400):
+
+    for tablename in ROLLUPS:
+        session.execute(text(f"DELETE FROM {tablename}"))
+
+    bounds = session.execute(text("SELECT CAST(strftime('%s', min(date)) AS INTEGER), CAST(strftime('%s', max(date)) AS INTEGER) FROM wxobs")).first()
+    if bounds[0] is None:
+        return
+
+    #chunk edges are aligned to whole days so no bucket is split across chunks
+    chunk_seconds = max(86400, chunk_seconds - chunk_seconds%86400)
+    cstart = bounds[0] - bounds[0]%86400
+    while cstart <= bounds[1]:
+        update_rollups(session, *masked_observations(session, bucketdate(cstart), bucketdate(cstart + chunk_seconds)))
+        cstart += chunk_seconds
+
+
+
+#coarsest rollup table whose buckets are no wider than the requested resolution (None = use raw obs)
+def choose_rollup(startdate, enddate, target):
+    resolution = (enddate - startdate).total_seconds()/max(target, 1)
+    best = None
+    for tablename, seconds in ROLLUPS.items():
+        if seconds <= resolution:
+            best = tablename
+    return best
+
+
+
+#reads a rollup table as ObservationArrays: per AGGREGATIONS, plus min/max envelopes for ENVELOPE_VARS
+def query_rollup(session, tablename, startdate, enddate, tzinfo, descending=False):
+
+    seconds = ROLLUPS[tablename]
+    query = (f"SELECT CAST(strftime('%s', date) AS INTEGER), {', '.join(ROLLUP_STATS)} FROM {tablename} "
+             f"WHERE date >= :start AND date <= :end ORDER BY date {'DESC' if descending else 'ASC'}")
+
+    #buckets that start before startdate but overlap the range are included
+    params = {'start':bucketdate(floor_epoch(startdate, seconds)), 'end':bucketdate(floor_epoch(enddate, 1))}
+    rows = session.execute(text(query), params).all()
+    data = rows_array(rows, len(ROLLUP_STATS) + 1)
+    stat = {name:data[:,i+1] for i,name in enumerate(ROLLUP_STATS)} #NULL min/max are NaN
+
+    #buckets without valid values of a variable leave it NaN (as decimate() does)
+    columns = {}
+    extremes = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for var in ROLLUP_VARS:
+            count = stat[var + '_count']
+            if AGGREGATIONS[var] == 'mean':
+                columns[var] = stat[var + '_sum']/count
+            else:
+                columns[var] = stat[var + '_' + AGGREGATIONS[var]]
+            if var in ENVELOPE_VARS:
+                extremes[var + '_min'] = stat[var + '_min']
+                extremes[var + '_max'] = stat[var + '_max']
+    columns['wdir'] = np.where(stat['wdir_count'] > 0, np.rad2deg(np.arctan2(stat['wdir_sin'], stat['wdir_cos'])) % 360, np.nan)
+
+    #convert to F
+    columns['temp'] = columns['temp']*9/5 + 32
+    for key in ['temp_min', 'temp_max']:
+        extremes[key] = extremes[key]*9/5 + 32
+
+    obs = ObservationArrays(data[:,0].astype(np.int64) + seconds//2, columns, tzinfo) #plotted at bucket centers
+    obs.extremes = extremes
+    return obs
+
+
+#epoch seconds for a naive UTC datetime, rounded down to a multiple of seconds
+def floor_epoch(date, seconds):
+    epoch = int((date - EPOCH).total_seconds())
+    return epoch - epoch%seconds
+
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from sqlalchemy import text
+
+
+
+#######################################################################################
+#                              CROSS-PROCESS NOTIFICATIONS                            #
+#######################################################################################
+
+#every worker process (e.g. gunicorn -w 4) keeps its own in-memory state and caches. Shared state lives in
+#the database, and each topic has a version counter in a (topic, version) table: a process that changes
+#the state bumps the version in the same transaction, and every process polls the versions to find out
+#which parts of its memory are stale. Workers must be started without --preload so each has its own threads.
+
+
+class ChangeNotifier():
+
+    def __init__(self, tablename, poll_interval=1.0):
+        self.tablename = tablename
+        self.poll_interval = poll_interval #seconds between version checks
+        self.handlers = {} #topic: [handler(), ...]
+        self.versions = None #topic: last version seen by this process (None until the first poll)
+        self.published = {} #topic: version of this process' own latest change
+        self.next_poll = 0
+        self.lock = threading.Lock()
+
+
+    def subscribe(self, topic, handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+
+    #records a change to topic (caller commits, so the notification is only seen with the data)
+    def publish(self, session, topic):
+        version = session.execute(text(f"INSERT INTO {self.tablename} (topic, version) VALUES (:topic, 1) "
+                                       f"ON CONFLICT(topic) DO UPDATE SET version = version + 1 RETURNING version"), {'topic': topic}).scalar()
+        with self.lock:
+            self.published[topic] = version
+
+
+    #runs the handlers of every topic another process changed since the last poll (at most once per poll_interval)
+    def poll(self, session, force=False):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_poll and not force:
+                return []
+            self.next_poll = now + self.poll_interval
+
+            versions = dict(session.execute(text(f"SELECT topic, version FROM {self.tablename}")).all())
+            if self.versions is None: #startup- state was just loaded from the database
+                self.versions = versions
+                return []
+
+            changed = []
+            for topic, version in versions.items():
+                seen = self.versions.get(topic, 0)
+                if version == seen:
+                    continue
+                self.versions[topic] = version
+                if version == seen + 1 and self.published.get(topic) == version: #only our own change
+                    continue
+                changed.append(topic)
+
+        for topic in changed:
+            for handler in self.handlers.get(topic, []):
+                handler()
+        return changed